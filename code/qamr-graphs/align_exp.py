@@ -1,12 +1,28 @@
 """ Usage:
-    align_exp --in=INPUT_FILE --out=OUTPUT_FILE
+    align_exp --in=INPUT_FILE --out=OUTPUT_FILE [--jobs=N] [--neighbours=TABLE_FILE] [--cache=CACHE_FILE] [--lemmas=LEMMA_FILE]
+              [--max-assignments=N] [--time-limit=SECONDS]
 
     Align QA to sentences a given experiment file
     outputs the aligned version into out_fn
+
+Options:
+    --jobs=N                  Number of worker processes to align with [default: 1]
+    --neighbours=TABLE_FILE   Look up fuzzy matches in a corpus wide neighbour table,
+                              which is created or extended with this file's vocabulary
+    --cache=CACHE_FILE        Reuse the alignments of previously seen QAs from this file,
+                              and add the new ones to it (with --jobs, only alignments
+                              from previous runs are reused)
+    --lemmas=LEMMA_FILE       Pre-compute the lemmas of this file's vocabulary before aligning,
+                              adding them to (and loading from) this file
+    --max-assignments=N       Align QAs greedily if a phrase has more than N possible assignments
+    --time-limit=SECONDS      Align QAs greedily if the exact search takes longer than this.
+                              QAs aligned greedily are listed in OUTPUT_FILE.fallbacks
 """
 
 from docopt import docopt
-from preproc import Aligner
+from preproc import Aligner, semi_process
+from fuzzy_matcher import NeighbourTable
+from alignment_cache import AlignmentCache
 import logging
 logging.basicConfig(level = logging.DEBUG)
 
@@ -14,7 +30,26 @@ if __name__ == "__main__":
     args = docopt(__doc__)
     inp = args["--in"]
     out = args["--out"]
+    jobs = int(args["--jobs"])
     logging.info("Aligning experiment file {} into {} ...".format(inp, out))
-    aligner = Aligner()
-    aligner.align_experiment(inp, out)
+    neighbours_fn = args["--neighbours"]
+    cache_fn = args["--cache"]
+    lemmas_fn = args["--lemmas"]
+    aligner = Aligner(neighbours = NeighbourTable(semi_process, neighbours_fn) \
+                      if neighbours_fn is not None else None,
+                      alignment_cache = AlignmentCache(cache_fn) \
+                      if cache_fn is not None else None,
+                      lemma_cache_fn = lemmas_fn,
+                      max_assignments = int(args["--max-assignments"]) \
+                      if args["--max-assignments"] is not None else None,
+                      time_limit = float(args["--time-limit"]) \
+                      if args["--time-limit"] is not None else None)
+    if lemmas_fn is not None:
+        logging.info("Updating lemmas {} ...".format(lemmas_fn))
+        aligner.warm_lemmas(inp)
+        aligner.lemmas.save()
+    if neighbours_fn is not None:
+        logging.info("Updating neighbour table {} ...".format(neighbours_fn))
+        aligner.update_neighbours(inp)
+    aligner.align_experiment(inp, out, jobs = jobs)
     logging.info("DONE!")
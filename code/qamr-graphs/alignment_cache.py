@@ -0,0 +1,136 @@
+""" Usage:
+    alignment_cache --cache=CACHE_FILE
+
+Print statistics of an on-disk cache of QA alignments (see align_exp --cache).
+"""
+
+from docopt import docopt
+import hashlib
+import os
+import logging
+logging.basicConfig(level = logging.DEBUG)
+
+# Mixed into all keys - bump whenever the alignment algorithm changes,
+# to invalidate previously cached alignments
+ALIGNMENT_VERSION = 1
+
+
+def get_alignment_key(sentence, question, answer, lemmatize, answer_alignment = None):
+    """
+    Returns a content hash of the inputs of Aligner.align_qa (tokenized sentence, question and answer,
+    and the answer alignment, if it's given)
+    """
+    return hashlib.sha1("\n".join([str(ALIGNMENT_VERSION),
+                                   " ".join(sentence),
+                                   " ".join(question),
+                                   " ".join(answer),
+                                   str(lemmatize)] + \
+                                  ([format_indices(answer_alignment)]
+                                   if answer_alignment is not None else []))).hexdigest()
+
+def format_indices(indices):
+    """
+    Serialize a list of alignment indices
+    """
+    return " ".join(map(str, indices))
+
+def parse_indices(s):
+    """
+    Parse a list of alignment indices serialized with format_indices
+    """
+    return map(int, s.split())
+
+
+class AlignmentCache:
+    """
+    On-disk cache of QA alignments (question alignment, answer alignment), keyed by get_alignment_key.
+    Stored as a tab separated file of (key, question alignment, answer alignment),
+    new alignments are appended as they're added.
+    """
+    def __init__(self, fn, read_only = False):
+        """
+        fn - file to load the cache from (if it exists) and to append new alignments to
+        read_only - don't write to fn, instead keep new alignments until pop_updates is called
+                    (used by worker processes, which report back to a single writer)
+        """
+        self.fn = fn
+        self.read_only = read_only
+        self.alignments = {}
+        self.hits = 0
+        self.misses = 0
+        self.new_alignments = []
+        if os.path.exists(fn):
+            for line in open(fn):
+                key, question_alignment, answer_alignment = line.rstrip("\n").split("\t")
+                self.alignments[key] = (parse_indices(question_alignment),
+                                        parse_indices(answer_alignment))
+        self.fout = None
+
+    def get(self, key):
+        """
+        Returns the cached alignment of key, or None if it isn't in the cache.
+        Counts hits and misses.
+        """
+        if key in self.alignments:
+            self.hits += 1
+            return self.alignments[key]
+        self.misses += 1
+        return None
+
+    def __contains__(self, key):
+        """
+        Returns True iff key is in the cache (without counting a hit or miss)
+        """
+        return key in self.alignments
+
+    def add(self, key, alignment):
+        """
+        Add an alignment (question alignment, answer alignment) to the cache,
+        if it isn't already there
+        """
+        if key in self.alignments:
+            return
+        self.alignments[key] = alignment
+        if self.read_only:
+            self.new_alignments.append((key, alignment))
+            return
+        if self.fout is None:
+            self.fout = open(self.fn, 'a')
+        question_alignment, answer_alignment = alignment
+        self.fout.write("{}\t{}\t{}\n".format(key,
+                                              format_indices(question_alignment),
+                                              format_indices(answer_alignment)))
+
+    def pop_updates(self):
+        """
+        Returns and resets the new alignments, hits and misses since the last call
+        """
+        ret = (self.new_alignments, self.hits, self.misses)
+        self.new_alignments = []
+        self.hits = 0
+        self.misses = 0
+        return ret
+
+    def merge_updates(self, updates):
+        """
+        Add the updates returned by pop_updates of another (read only) cache
+        """
+        new_alignments, hits, misses = updates
+        for key, alignment in new_alignments:
+            self.add(key, alignment)
+        self.hits += hits
+        self.misses += misses
+
+    def close(self):
+        """
+        Flush new alignments to disk
+        """
+        if self.fout is not None:
+            self.fout.close()
+            self.fout = None
+
+
+if __name__ == "__main__":
+    args = docopt(__doc__)
+    cache = AlignmentCache(args["--cache"], read_only = True)
+    print "{} cached alignments".format(len(cache.alignments))
@@ -0,0 +1,43 @@
+"""
+Helpers for feeding streams to worker pools in bounded batches.
+Kept free of heavy imports, so that light scripts (e.g., convert_dropbox) can use them
+without loading the alignment stack in preproc.
+"""
+
+import itertools
+from multiprocessing import Pool
+
+
+def iter_batches(iterable, size):
+    """
+    Yields lists of (at most) size consecutive elements of iterable.
+    """
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def imap_batches(func, iterable, jobs, batch_size, initializer = None, initargs = ()):
+    """
+    Lazily yields func(element) for each element of iterable, in order, computed by
+    a pool of jobs worker processes (started on the first request).
+    The pool is fed in bounded batches of jobs * batch_size elements,
+    so that reading iterable doesn't run ahead of the workers.
+    The pool is closed once all results are yielded, and terminated if anything fails,
+    or if the generator is closed before that (e.g., with contextlib.closing, when
+    the consumer fails).
+    """
+    pool = Pool(jobs, initializer = initializer, initargs = initargs)
+    try:
+        for batch in iter_batches(iterable, jobs * batch_size):
+            for result in pool.imap(func, batch):
+                yield result
+    except:
+        pool.terminate()
+        pool.join()
+        raise
+    pool.close()
+    pool.join()
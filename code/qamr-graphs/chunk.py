@@ -1,10 +1,25 @@
 """ Usage:
-   chunk --in=INPUT_FILE (--projective | --non-projective) [--single-words] [--html=OUTPUT_DIR] [--psd=PSD_FILE] [--txt=TXT_FILE] [--amr=AMR_FILE] [--concepts=CONCEPTS_FILE] [--triples=TRIPLES_FILE]
+   chunk --in=INPUT_FILE (--projective | --non-projective) [--sents=SENT_FILE] [--single-words] [--html=OUTPUT_DIR] [--psd=PSD_FILE] [--txt=TXT_FILE] [--amr=AMR_FILE] [--concepts=CONCEPTS_FILE] [--triples=TRIPLES_FILE]
+         [--batch-size=N] [--n-process=N] [--parse-cache=CACHE_FILE]
+
+If --sents is given, INPUT_FILE is read in the released QAMR tsv format (e.g., data/filtered/dev.tsv)
+with SENT_FILE mapping sentence ids to sentences (e.g., data/wiki-sentences.tsv).
+If INPUT_FILE is a directory, it is read as a compiled corpus cache (see corpus_cache.py).
+Otherwise, INPUT_FILE is an aligned experiment file (see align_exp.py).
+Sentences and questions are parsed in bulk, in blocks of consecutive sentences.
+If --parse-cache is given, parses are stored in (and loaded from) CACHE_FILE, keyed by their
+text and the spaCy model, so later runs only parse new texts.
+
+Options:
+    --batch-size=N  Number of texts spaCy parses together [default: 1000]
+    --n-process=N   Number of parsing processes, each loading the spaCy model once [default: 1]
 """
 
 from collections import defaultdict
 from operator import itemgetter
-from data_structures import Sentence, Edge, load_sentences, EdgePossibilities, Graph_to_amr
+from data_structures import Sentence, Edge, load_sentences, iter_sentences, EdgePossibilities, Graph_to_amr,\
+    iter_tsv_sentences, load_wiki_sentences, iter_indexed_sentences, iter_parsed_sentences
+from corpus_cache import CorpusCache
 from preproc import split_list,is_subchunk, uniq, reachable_from, non_projective_edge,\
     intersecting_spans, find_heads, find_parents, graph_to_triples, split_consecutive
 import networkx as nx
@@ -15,8 +30,9 @@ import pdb
 from docopt import docopt
 from pprint import pprint
 from brat_handler import Brat
-from spacy_wrapper import spacy_with_whitespace_tokenizer as spacy_ws
-from spacy_wrapper import find_root
+from spacy_wrapper import set_parse_cache, close_parse_pool, PARSE_BATCH_SIZE
+from parse_cache import ParseCache
+from spacy_wrapper import find_span_root
 
 # Ideas:
 # - Signals for predicates:
@@ -46,7 +62,6 @@ class QAStructure:
         }
         self.total_edge_count = 0
         self.question_rels_count = 0
-        self.parser = spacy_ws.parser
 
     def process(self, projective, single_words):
         """
@@ -66,7 +81,7 @@ class QAStructure:
     def split_to_words(self):
         """
         After constructing the graph, find nodes which spans multiple
-        words and break them according to dependency parse.
+        words and break them according to the sentence's dependency parse.
         """
         # Find nodes which span mulitple words
         multi_word_nodes = [(node_start, node_end)
@@ -74,13 +89,12 @@ class QAStructure:
                             if (node_end - node_start) > 1]
 
         # Break each of these according to dependency parse
+        sentence_parse = self.sent.sentence_spacy_parse
         for (start, end) in multi_word_nodes:
             cur_node = (start, end)
-            dep_tree = self.parser(unicode(" ".join(self.sent.sentence[start : end]),
-                                           "utf8"))
-            root = find_root(dep_tree)
-            root_node = (start + root.i,
-                         start + root.i + 1)
+            root = find_span_root(sentence_parse, start, end)
+            root_node = (root.i,
+                         root.i + 1)
 
             # Duplicate edges from the multi-word to its head
             for parent_node in self.digraph.predecessors(cur_node):
@@ -93,16 +107,17 @@ class QAStructure:
                                       child_node,
                                       label = self.digraph[cur_node][child_node]['label'])
 
-            # Add dependency edges
-            for node in dep_tree:
-                if node == root:
+            # Add dependency edges, words headed outside of the span are attached to its root
+            for node in [sentence_parse[i] for i in range(start, end)]:
+                if node.i == root.i:
                     continue
                 if node.dep_ not in ["cc", "prep"]:
-
-                    self.digraph.add_edge((start + node.head.i,
-                                           start + node.head.i + 1),
-                                          (start + node.i,
-                                           start + node.i + 1),
+                    head_ind = node.head.i if (start <= node.head.i < end) \
+                               else root.i
+                    self.digraph.add_edge((head_ind,
+                                           head_ind + 1),
+                                          (node.i,
+                                           node.i + 1),
                                           label = ["dep:{}".format(node.dep_)])
 
         #  Remove all multi word nodes from the graph
@@ -676,9 +691,8 @@ def get_psd_from_graph(sent):
                            if digraph.neighbors(node)],
                           key = itemgetter(0))
 
-    # Parse for POS
-    parsed_sent = spacy_ws.parser(unicode(sent.sent.sentence_str,
-                                          "utf8"))
+    # POS and lemmas from the sentence parse
+    parsed_sent = sent.sent.sentence_spacy_parse
 
     # Format output and return
     return '\n'.join(["\t".join([str(word_ind + 1),
@@ -726,77 +740,110 @@ def is_psd_pred(digraph, word_ind):
 
 
 def main(fn, projective, single_words, text_format, html_format,
-         amr_format, concepts_format, triples_format, psd_format):
+         amr_format, concepts_format, triples_format, psd_format,
+         sents_fn = None, batch_size = PARSE_BATCH_SIZE, n_process = 1,
+         parse_cache_fn = None):
     """
-    Parse QA annotation of sentences and output pred-args structures
+    Parse QA annotation of sentences and output pred-args structures.
+    Sentences are read, processed and written one at a time (after being parsed
+    in blocks), so that memory doesn't depend on the size of the input.
+    sents_fn - if given, fn is read as a QAMR tsv file with sentences from sents_fn
+    batch_size, n_process - spaCy parsing parameters, see spacy_wrapper.parse_texts
+    parse_cache_fn - if given, an on-disk cache of parses (see parse_cache.py)
+    Returns the number of processed sentences.
     """
-    processed_sents = []
-
-    for i, sent in enumerate(sents):
-        logging.debug("{} / {}".format(i+1, len(sents)))
-        s = process_sent(sent,
-                         projective,
-                         single_words,
-                         -1)
-        processed_sents.append(s)
-
-    if concepts_format:
-        fn = concepts_format
-        with open(fn, 'w') as fout:
-            fout.write("\n".join(["{}\t{}".format(s.sent,
-                                                  '\t'.join([" ".join(s.sent.sentence[span[0]: span[1]])
-                                                             for span in s.count_chunks]))
-                                  for s in processed_sents
-            ]))
-
-        logging.debug("writing output to {}".format(fn))
-
-    if triples_format:
-        fn = triples_format
-        with open(fn, 'w') as fout:
-            for s in processed_sents:
-                for triple in graph_to_triples(s.digraph, s.sent.sentence):
-                    fout.write("{0}\t{1}\n".format(s.sent, triple))
-
-
-    if text_format:
-        fn = text_format
-        with open(fn, 'w') as fout:
-            fout.write("\n\n".join([s.get_text_pas(s.pas)
-                                    for s in processed_sents]))
-        logging.debug("writing output to {}".format(fn))
-
+    if os.path.isdir(fn):
+        sents = iter_indexed_sentences(CorpusCache(fn).iter_records())
+    elif sents_fn:
+        sents = iter_tsv_sentences(fn, load_wiki_sentences(sents_fn))
+    else:
+        sents = iter_sentences(fn)
+    sents = iter_parsed_sentences(sents,
+                                  batch_size = batch_size,
+                                  n_process = n_process)
+
+    # Open all requested outputs upfront
+    outputs = dict([(name, open(out_fn, 'w'))
+                    for (name, out_fn) in [("concepts", concepts_format),
+                                           ("triples", triples_format),
+                                           ("txt", text_format),
+                                           ("psd", psd_format),
+                                           ("amr", amr_format)]
+                    if out_fn])
     if html_format:
-        base_dir = html_format
-        with open(os.path.join(base_dir, "index.html"), 'w') as fout:
-            for i, s in enumerate(processed_sents):
-                s.output_brat_html(os.path.join(base_dir, "{}.html".format(i)), [s.digraph])
-                fout.write("{}{}</a><br><br>\n".format("<a href = {}.html target=_blank>".format(i)
-                                                       if processed_sents[i].digraph
-                                                       else "[EMPTY] ",
-                                                       s.sent))
-    if psd_format:
-        fn = psd_format
-        with open(fn, 'w') as fout:
-            for sent_ind, sent in enumerate(processed_sents):
-                psd = get_psd_from_graph(sent).encode("utf8")
-                fout.write("#{}\n{}".format(sent.sent.sentence_id,
-                                            psd) + "\n\n")
-        logging.debug("Wrote PSD output to {}".format(fn))
-
-    if amr_format:
-        fn = amr_format
-        with open(fn, 'w') as fout:
-            fout.write("\n\n".join(["# ::snt {}\n{}".format(s.sent, s.amr)
-                                    for s in processed_sents]))
+        outputs["html"] = open(os.path.join(html_format, "index.html"), 'w')
 
-    return processed_sents
+    parse_cache = ParseCache(parse_cache_fn) if parse_cache_fn else None
+    set_parse_cache(parse_cache)
+
+    num_of_sents = 0
+    try:
+        for i, sent in enumerate(sents):
+            logging.debug("Processing sentence #{}".format(i+1))
+            if sent.sentence_spacy_parse is None:
+                logging.warning("Skipping unparsed sentence: {}".format(sent))
+                continue
+            s = process_sent(sent,
+                             projective,
+                             single_words,
+                             -1)
+            write_outputs(s, num_of_sents, outputs, html_format)
+            num_of_sents += 1
+    except:
+        # Don't leave parsing processes behind
+        close_parse_pool(terminate = True)
+        raise
+    finally:
+        close_parse_pool()
+        for fout in outputs.values():
+            fout.close()
+            logging.debug("Wrote output to {}".format(fout.name))
+        if parse_cache is not None:
+            parse_cache.close()
+            set_parse_cache(None)
+            logging.info("Parse cache: {} hits, {} misses".format(parse_cache.hits,
+                                                                  parse_cache.misses))
+
+    return num_of_sents
+
+def write_outputs(s, i, outputs, html_format):
+    """
+    Write a single processed sentence (the ith) to all of the open outputs.
+    """
+    if "concepts" in outputs:
+        outputs["concepts"].write(("\n" if i else "") + \
+                                  "{}\t{}".format(s.sent,
+                                                  '\t'.join([" ".join(s.sent.sentence[span[0]: span[1]])
+                                                             for span in s.count_chunks])))
+
+    if "triples" in outputs:
+        for triple in graph_to_triples(s.digraph, s.sent.sentence):
+            outputs["triples"].write("{0}\t{1}\n".format(s.sent, triple))
+
+    if "txt" in outputs:
+        outputs["txt"].write(("\n\n" if i else "") + \
+                             s.get_text_pas(s.pas))
+
+    if "html" in outputs:
+        s.output_brat_html(os.path.join(html_format, "{}.html".format(i)), [s.digraph])
+        outputs["html"].write("{}{}</a><br><br>\n".format("<a href = {}.html target=_blank>".format(i)
+                                                          if s.digraph
+                                                          else "[EMPTY] ",
+                                                          s.sent))
+    if "psd" in outputs:
+        psd = get_psd_from_graph(s).encode("utf8")
+        outputs["psd"].write("#{}\n{}".format(s.sent.sentence_id,
+                                              psd) + "\n\n")
+
+    if "amr" in outputs:
+        outputs["amr"].write(("\n\n" if i else "") + \
+                             "# ::snt {}\n{}".format(s.sent, s.amr))
 
 if __name__ == "__main__":
     args = docopt(__doc__)
     dummy_file = "./testing/out.csv"
     fn = args["--in"]
-    sents = load_sentences(fn)
+    sents_fn = args["--sents"]
     projective = args["--projective"]
     single_words = args["--single-words"]
     txt_format = args["--txt"]
@@ -805,13 +852,20 @@ if __name__ == "__main__":
     psd_format = args["--psd"]
     concepts_format = args["--concepts"]
     triples_format = args["--triples"]
-
-    procs = main(fn,
-                 projective,
-                 single_words,
-                 txt_format,
-                 html_format,
-                 amr_format,
-                 concepts_format,
-                 triples_format,
-                 psd_format)
+    batch_size = int(args["--batch-size"])
+    n_process = int(args["--n-process"])
+    parse_cache_fn = args["--parse-cache"]
+
+    num_of_sents = main(fn,
+                        projective,
+                        single_words,
+                        txt_format,
+                        html_format,
+                        amr_format,
+                        concepts_format,
+                        triples_format,
+                        psd_format,
+                        sents_fn,
+                        batch_size,
+                        n_process,
+                        parse_cache_fn)
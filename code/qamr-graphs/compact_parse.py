@@ -0,0 +1,185 @@
+"""
+Compact, array backed representation of spaCy parses.
+Keeps only what the graph induction reads (words, tags, lemmas, dependency labels and heads),
+so parses can be retained for a whole corpus after their spaCy Docs are released.
+"""
+
+from array import array
+
+# Fields stored per token, in the order they're packed in CompactParse.data
+FIELDS = ["text", "tag_", "lemma_", "dep_"]
+NUM_FIELDS = len(FIELDS) + 1 # Followed by the head index
+HEAD_FIELD = len(FIELDS)
+
+
+# Process wide interning of strings to consecutive integer ids, see get_string_id
+string_ids = {}
+strings = []
+
+
+def get_string_id(s):
+    """
+    Return the id of the given string, adding it to the string table if needed
+    """
+    if s not in string_ids:
+        string_ids[s] = len(strings)
+        strings.append(s)
+    return string_ids[s]
+
+
+class CompactParse(object):
+    """
+    A read only view of a parse, supporting the parts of spaCy's Doc interface used
+    in this package - len, indexing and iteration over tokens.
+    All fields are packed in a single int array, with strings stored as ids (see get_string_id).
+    """
+    __slots__ = ["data", "tokens", "children"]
+
+    def __init__(self, fields):
+        """
+        fields - list of (text, tag, lemma, dep, head index) per token
+        """
+        self.data = array('i')
+        for token_fields in fields:
+            self.data.extend([get_string_id(s)
+                              for s in token_fields[: HEAD_FIELD]] + \
+                             [token_fields[HEAD_FIELD]])
+        # Created on first access
+        self.tokens = None
+        self.children = None
+
+    @staticmethod
+    def from_doc(doc):
+        """
+        Convert a spaCy Doc, which can be released afterwards
+        """
+        return CompactParse(get_fields(doc))
+
+    def get_fields(self):
+        """
+        Returns the list of (text, tag, lemma, dep, head index) of this parse's tokens,
+        the inverse of the constructor (e.g., to pass between processes).
+        """
+        return [tuple([strings[string_id]
+                       for string_id in self.data[start : start + HEAD_FIELD]] + \
+                      [self.data[start + HEAD_FIELD]])
+                for start in range(0, len(self.data), NUM_FIELDS)]
+
+    def get(self, i, field):
+        """
+        Returns the value of a field (index in the packed token fields) of the ith token
+        """
+        value = self.data[i * NUM_FIELDS + field]
+        return value if field == HEAD_FIELD \
+            else strings[value]
+
+    def get_children(self, i):
+        """
+        Returns the indices of the ith token's children, in order
+        """
+        if self.children is None:
+            self.children = [[] for _ in range(len(self))]
+            for child in range(len(self)):
+                head = self.get(child, HEAD_FIELD)
+                if head != child:
+                    self.children[head].append(child)
+        return self.children[i]
+
+    def __len__(self):
+        return len(self.data) / NUM_FIELDS
+
+    def __getitem__(self, i):
+        """
+        Returns the ith token, which is the same object on every access
+        (allowing identity checks, such as w.head is w)
+        """
+        if self.tokens is None:
+            self.tokens = [CompactToken(self, token_ind)
+                           for token_ind in range(len(self))]
+        return self.tokens[i]
+
+    def __iter__(self):
+        return iter([self[i] for i in range(len(self))])
+
+    def __unicode__(self):
+        return u" ".join([tok.text for tok in self])
+
+    def __str__(self):
+        return unicode(self).encode("utf8")
+
+
+class CompactToken(object):
+    """
+    A token in a CompactParse, with spaCy's Token attributes used in this package
+    """
+    __slots__ = ["parse", "i"]
+
+    def __init__(self, parse, i):
+        """
+        parse - the containing CompactParse
+        i - index of this token in the parse
+        """
+        self.parse = parse
+        self.i = i
+
+    text = property(lambda self: self.parse.get(self.i, 0))
+    tag_ = property(lambda self: self.parse.get(self.i, 1))
+    lemma_ = property(lambda self: self.parse.get(self.i, 2))
+    dep_ = property(lambda self: self.parse.get(self.i, 3))
+    orth_ = text
+    lower_ = property(lambda self: self.text.lower())
+
+    @property
+    def head(self):
+        return self.parse[self.parse.get(self.i, HEAD_FIELD)]
+
+    @property
+    def children(self):
+        return [self.parse[child]
+                for child in self.parse.get_children(self.i)]
+
+    @property
+    def lefts(self):
+        return [child
+                for child in self.children
+                if child.i < self.i]
+
+    @property
+    def rights(self):
+        return [child
+                for child in self.children
+                if child.i > self.i]
+
+    @property
+    def subtree(self):
+        """
+        This token and all of its descendants, in order
+        """
+        ret = []
+        stack = [self]
+        while stack:
+            tok = stack.pop()
+            ret.append(tok)
+            stack.extend(tok.children)
+        return sorted(ret,
+                      key = lambda tok: tok.i)
+
+    def __len__(self):
+        return len(self.text)
+
+    def __unicode__(self):
+        return self.text
+
+    def __str__(self):
+        return self.text.encode("utf8")
+
+    def __repr__(self):
+        return str(self)
+
+
+def get_fields(doc):
+    """
+    Returns the list of (text, tag, lemma, dep, head index) of a spaCy Doc's tokens
+    """
+    return [(tok.text, tok.tag_, tok.lemma_, tok.dep_, tok.head.i)
+            for tok in doc]
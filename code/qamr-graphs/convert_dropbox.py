@@ -1,12 +1,20 @@
 """ Usage:
-   convert_dropbox --in=INPUT_FILE --sents=SENT_FILE --out=OUTPUT_FILE [--dont_use_alignment] [--extended] [--debug]
+   convert_dropbox --in=INPUT_FILE --sents=SENT_FILE --out=OUTPUT_FILE [--dont_use_alignment] [--extended] [--use_indices] [--jobs=N] [--debug]
+
+Options:
+   --jobs=N       Number of worker processes, each converting whole sentences [default: 1]
+   --use_indices  (Extended format only) add the sentence indices of each answer as a fifth field,
+                  which align_exp then uses instead of fuzzy aligning the answer
 """
 
 import csv
 import pdb
-import pandas as pd
-from pandas import DataFrame
 from docopt import docopt
+from itertools import groupby
+from operator import itemgetter
+from contextlib import closing
+from sentence_index import SentenceIndex, load_index
+from batches import imap_batches
 import logging
 logging.basicConfig(level = logging.DEBUG)
 
@@ -49,22 +57,39 @@ class Dropbox_parser:
     all different formats
     """
 
-    def __init__(self, sents_dict, use_alignment, extended):
+    def __init__(self, write_row, sents_dict, use_alignment, extended, use_indices = False):
         """
         Init internal state
+        write_row - called with each output row, as soon as it's parsed (e.g., csv writer's writerow)
         use_alignment - whether to use the alignemnt provided in the file
         extended - whether to expect extended or standard format in the file
+        use_indices - whether to output the answer indices given in the (extended) file
         """
-        self.df = DataFrame()
-        self.cur_df_index = 0
+        self.write_row = write_row
+        self.cur_sent_id = None
+        self.cur_sent = None
         self.use_alignment = use_alignment
+        self.use_indices = use_indices
         self.parse_row = self.parse_extended_row if extended \
                          else self.parse_standard_row
         self.sents_dict = sents_dict
 
+    def add_row(self, row):
+        """
+        Parse a row, preceded by a row introducing its sentence,
+        if it's the first of a new sentence
+        """
+        if row[0] != self.cur_sent_id:
+            self.cur_sent_id = row[0]
+            self.cur_sent = self.sents_dict[row[0]]
+            self.write_row([self.cur_sent] + [''] * (4 if self.use_indices \
+                                                               else 5 if self.use_alignment \
+                                                               else 3))
+        self.parse_row(row)
+
     def parse_standard_row(self, row):
         """
-        Parse a standard row into df
+        Parse a standard row
         """
         ptb_ind,sent_ind, \
             worker_id, special_word, question_mapping, question = row[: 6]
@@ -79,14 +104,14 @@ class Dropbox_parser:
                               special_word,
                               question,
                               answer] +\
-                              ([align(sent, question, question_mapping), align(sent, answer, ans_map)]
+                              ([align(self.cur_sent, question, question_mapping),
+                                align(self.cur_sent, answer, ans_map)]
                                  if self.use_alignment else []) # Potentially drop the mapping
-                self.df[self.cur_df_index] = output_row
-                self.cur_df_index += 1
+                self.write_row(output_row)
 
     def parse_extended_row(self, row):
         """
-        Parse a row into df
+        Parse an extended row
         """
         # ptb_ind,sent_ind, (special_words_group),\
             #     worker_id, special_word, question_mapping, question = row[: 7]
@@ -94,29 +119,83 @@ class Dropbox_parser:
         sent_id, special_words_group, worker_id, qa_index, \
             special_word_ind, question, ans_map, validator_1, validator_2 = row
         sent = self.sents_dict[sent_id].split(' ')
+        answers_indices = [ans_map.split(),
+                           validator_1.split(':')[1].split(),
+                           validator_2.split(':')[1].split()]
         answers = [" ".join([sent[int(word_ind)]
                              for word_ind in ls])
-                   for ls in [ans_map.split(),
-                              validator_1.split(':')[1].split(),
-                              validator_2.split(':')[1].split()]]
+                   for ls in answers_indices]
         special_word= sent[int(special_word_ind)]
 
         # answers = [ans for ans in row[8 : 8 + num_of_annots]]
         # answers_mapping = [m for m in row[8 + num_of_annots : 8 + (2 * num_of_annots)]]
-        for answer in answers:
+        for answer, answer_indices in zip(answers, answers_indices):
             output_row = [worker_id,
                           special_word,
                           question,
-                          answer] # +\
+                          answer] +\
+                          ([" ".join(answer_indices)]
+                           if self.use_indices else []) # Answer alignment, skips fuzzy aligning it
                           # ([align(sent, question, question_mapping), align(sent, answer, ans_map)]
                           #  if self.use_alignment else []) # Potentially drop the mapping
-            self.df[self.cur_df_index] = output_row
-            self.cur_df_index += 1
+            self.write_row(output_row)
 
 
 # Constants
 NUM_OF_ANNOTS = 3
 
+# Number of sentences per worker in a batch, see convert_file
+CONVERT_BATCH_SIZE = 32
+
+# The sentence index and parser arguments of the current worker process (see init_convert_worker)
+worker_sents_dict = None
+worker_parser_args = None
+
+def init_convert_worker(sent_fn, parser_args):
+    """
+    Pool initializer - open the sentence index once per worker process
+    (its sidecar index is built by convert_file, before the pool is started)
+    """
+    global worker_sents_dict, worker_parser_args
+    worker_sents_dict = SentenceIndex(sent_fn)
+    worker_parser_args = parser_args
+
+def convert_rows_worker(rows):
+    """
+    Convert the input rows of a single sentence in a worker process,
+    returns the output rows.
+    """
+    ret = []
+    db = Dropbox_parser(ret.append, worker_sents_dict, *worker_parser_args)
+    for row in rows:
+        db.add_row(row)
+    return ret
+
+def convert_file(fn_in, sent_fn, fn_out, use_alignment, extended, use_indices, jobs = 1):
+    """
+    Convert a dropbox file to an experiment file, streaming rows as they're parsed.
+    jobs - number of worker processes, input is sharded by (consecutive) sentence id,
+           and output is written in the original order.
+    """
+    parser_args = (use_alignment, extended, use_indices)
+    with open(fn_in) as fin, open(fn_out, 'w') as fout:
+        reader = csv.reader(fin, delimiter = '\t', quotechar='|')
+        writer = csv.writer(fout, lineterminator = '\n')
+        if jobs > 1:
+            # Build (or load) the sentence index once, before the workers open it
+            load_index(sent_fn)
+            sentences = (list(rows) for (sent_id, rows) in groupby(reader, itemgetter(0)))
+            with closing(imap_batches(convert_rows_worker, sentences, jobs, CONVERT_BATCH_SIZE,
+                                      initializer = init_convert_worker,
+                                      initargs = (sent_fn, parser_args))) as converted_sentences:
+                for output_rows in converted_sentences:
+                    writer.writerows(output_rows)
+        else:
+            # Random access to sentences by id, without loading the whole sentence file
+            db = Dropbox_parser(writer.writerow, SentenceIndex(sent_fn), *parser_args) # Init dropbox parser
+            for row in reader:
+                db.add_row(row)
+
 if __name__ == "__main__":
     args = docopt(__doc__)
     logging.debug(args)
@@ -125,25 +204,9 @@ if __name__ == "__main__":
     fn_out = args["--out"]
     use_alignment = not args["--dont_use_alignment"]
     extended = bool(args["--extended"])
-    cnt = 0
-    sent_ind = None
-    sents_dict = dict([line.strip().split('\t')
-                       for line in open(sent_fn)])
-    with open(fn_in) as fin:
-        reader = csv.reader(fin, delimiter = '\t', quotechar='|')
-        db = Dropbox_parser(sents_dict, use_alignment, extended) # Init dropbox parser
-        for row in reader:
-            cur_sent_ind = row[0]
-            if (cur_sent_ind != sent_ind):
-                # This is a row introducing a new sentence
-                sent_ind = cur_sent_ind
-                sent = sents_dict[cur_sent_ind]
-                db.df[db.cur_df_index] = ([sent] + [''] * (5 if use_alignment else 3))
-                db.cur_df_index += 1
-
-            db.parse_row(row)
-
-    # Get the parsed dataframe from the dropbox instance
-    df = db.df
-    df.transpose().to_csv(fn_out, header = False, index = False, line_terminator='\n')
+    use_indices = bool(args["--use_indices"])
+    if use_indices and not extended:
+        raise Exception("--use_indices requires --extended")
+    jobs = int(args["--jobs"])
+    convert_file(fn_in, sent_fn, fn_out, use_alignment, extended, use_indices, jobs = jobs)
     logging.info("DONE")
@@ -0,0 +1,236 @@
+""" Usage:
+    corpus_cache --in=INPUT_FILE --sents=SENT_FILE --out=CACHE_DIR
+
+Compile a QAMR tsv file (e.g., data/filtered/dev.tsv) into a columnar binary cache,
+which can later be opened with near zero load time (e.g., chunk.py --in=CACHE_DIR).
+Arrays are memory mapped, so several processes can share the same pages.
+"""
+
+from docopt import docopt
+from array import array
+import numpy as np
+import json
+import nltk
+import os
+import logging
+logging.basicConfig(level = logging.DEBUG)
+
+from data_structures import load_wiki_sentences, is_index_judgment
+
+# Cache format version - bump whenever the layout changes
+CACHE_FORMAT = 1
+
+# Status of a judgment (worker answer or validator response).
+# Non-negative values indicate a redundancy with the QA at this index
+# in the same assignment.
+ANSWER_JUDGMENT = -1
+INVALID_JUDGMENT = -2
+
+# Names of the numpy arrays in the cache, see compile_corpus for details
+ARRAY_NAMES = ["sent_tokens", "sent_offsets", "sent_qa_offsets",
+               "qa_worker", "qa_index", "qa_target",
+               "hit_targets", "hit_offsets",
+               "question_tokens", "question_offsets",
+               "judge_ids", "judgment_status",
+               "judgment_inds", "judgment_offsets"]
+
+# Names of the (newline separated) string tables in the cache
+TABLE_NAMES = ["vocab", "workers", "sent_ids"]
+
+
+class StringTable:
+    """
+    Intern strings to consecutive integer ids
+    """
+    def __init__(self):
+        """
+        Start with an empty table
+        """
+        self.ids = {}
+        self.strings = []
+
+    def get_id(self, s):
+        """
+        Return the id of the given string, adding it to the table if needed
+        """
+        if s not in self.ids:
+            self.ids[s] = len(self.strings)
+            self.strings.append(s)
+        return self.ids[s]
+
+
+def parse_judgment(judgment):
+    """
+    Parse a validator judgment (the part after the colon) into (status, indices)
+    """
+    if is_index_judgment(judgment):
+        return ANSWER_JUDGMENT, map(int, judgment.split())
+    if judgment.startswith("Redundant-"):
+        return int(judgment.split("-", 1)[1]), []
+    return INVALID_JUDGMENT, []
+
+def compile_corpus(fn, sents_dict, out_dir):
+    """
+    Compile the QAMR tsv file fn into a columnar cache in out_dir.
+    Layout (all offsets arrays have one more entry than the elements they index):
+    - sent_tokens / sent_offsets - vocab ids of the sentences' tokens
+    - sent_qa_offsets - the range of QAs pertaining to each sentence
+    - qa_worker, qa_index, qa_target - per QA worker id, index in assignment and target word
+    - hit_targets / hit_offsets - the set of target words in each QA's HIT
+    - question_tokens / question_offsets - vocab ids of each QA's tokenized question
+    - judge_ids, judgment_status - three judgments per QA (worker answer, validator 1, validator 2)
+    - judgment_inds / judgment_offsets - sentence indices of each judgment
+    """
+    arrays = dict([(name, array('i')) for name in ARRAY_NAMES])
+    tables = dict([(name, StringTable()) for name in TABLE_NAMES])
+    for name in ["sent_offsets", "sent_qa_offsets", "hit_offsets",
+                 "question_offsets", "judgment_offsets"]:
+        arrays[name].append(0)
+
+    cur_sent_id = None
+    with open(fn) as fin:
+        for line in fin:
+            row = line.rstrip("\n").split("\t")
+            sent_id, target_words, worker_id, qa_index, \
+                target_word_ind, question, answer, validator_1, validator_2 = row[: 9]
+
+            if sent_id != cur_sent_id:
+                # A new sentence
+                if cur_sent_id is not None:
+                    arrays["sent_qa_offsets"].append(len(arrays["qa_worker"]))
+                cur_sent_id = sent_id
+                tables["sent_ids"].get_id(sent_id)
+                arrays["sent_tokens"].extend([tables["vocab"].get_id(w)
+                                              for w in sents_dict[sent_id].split(" ")])
+                arrays["sent_offsets"].append(len(arrays["sent_tokens"]))
+
+            arrays["qa_worker"].append(tables["workers"].get_id(worker_id))
+            arrays["qa_index"].append(int(qa_index))
+            arrays["qa_target"].append(int(target_word_ind))
+            arrays["hit_targets"].extend(map(int, target_words.split()))
+            arrays["hit_offsets"].append(len(arrays["hit_targets"]))
+            arrays["question_tokens"].extend([tables["vocab"].get_id(w)
+                                              for w in nltk.word_tokenize(question)])
+            arrays["question_offsets"].append(len(arrays["question_tokens"]))
+
+            for judge, judgment in [(worker_id, answer)] + \
+                                   [validator.split(":", 1)
+                                    for validator in [validator_1, validator_2]]:
+                status, inds = parse_judgment(judgment)
+                arrays["judge_ids"].append(tables["workers"].get_id(judge))
+                arrays["judgment_status"].append(status)
+                arrays["judgment_inds"].extend(inds)
+                arrays["judgment_offsets"].append(len(arrays["judgment_inds"]))
+
+    arrays["sent_qa_offsets"].append(len(arrays["qa_worker"]))
+
+    # Write to disk
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    for name, arr in arrays.iteritems():
+        np.save(os.path.join(out_dir, "{}.npy".format(name)),
+                np.frombuffer(arr, dtype = np.int32) if arr \
+                else np.zeros(0, dtype = np.int32))
+    for name, table in tables.iteritems():
+        with open(os.path.join(out_dir, "{}.txt".format(name)), 'w') as fout:
+            fout.write("\n".join(table.strings))
+    with open(os.path.join(out_dir, "meta.json"), 'w') as fout:
+        json.dump({"format": CACHE_FORMAT,
+                   "source": os.path.abspath(fn),
+                   "num_of_sentences": len(tables["sent_ids"].strings),
+                   "num_of_qas": len(arrays["qa_worker"])},
+                  fout)
+
+    logging.info("Compiled {} sentences, {} QAs into {}".format(len(tables["sent_ids"].strings),
+                                                                len(arrays["qa_worker"]),
+                                                                out_dir))
+
+
+class CorpusCache:
+    """
+    Read only, memory mapped, access to a compiled corpus (see compile_corpus)
+    """
+    def __init__(self, cache_dir):
+        """
+        Open the cache in cache_dir. Arrays are memory mapped - nothing
+        is read from disk until it's accessed.
+        """
+        self.cache_dir = cache_dir
+        self.meta = json.load(open(os.path.join(cache_dir, "meta.json")))
+        if self.meta["format"] != CACHE_FORMAT:
+            raise Exception("{} has cache format {}, expected {} - please recompile".\
+                            format(cache_dir, self.meta["format"], CACHE_FORMAT))
+
+        for name in ARRAY_NAMES:
+            setattr(self, name, np.load(os.path.join(cache_dir, "{}.npy".format(name)),
+                                        mmap_mode = 'r'))
+        for name in TABLE_NAMES:
+            content = open(os.path.join(cache_dir, "{}.txt".format(name))).read()
+            setattr(self, name, content.split("\n") if content else [])
+
+    def __len__(self):
+        """
+        Returns the number of sentences in the cache
+        """
+        return len(self.sent_ids)
+
+    def get_tokens(self, token_ids):
+        """
+        Map vocab ids back to tokens
+        """
+        return [self.vocab[token_id] for token_id in token_ids]
+
+    def get_sentence(self, sent_ind):
+        """
+        Returns the (space tokenized) sentence at the given index
+        """
+        return " ".join(self.get_tokens(self.sent_tokens[self.sent_offsets[sent_ind]:
+                                                         self.sent_offsets[sent_ind + 1]]))
+
+    def get_judgment(self, judgment_ind):
+        """
+        Returns (judge id, status, sentence indices) of the given judgment
+        """
+        return (self.workers[self.judge_ids[judgment_ind]],
+                int(self.judgment_status[judgment_ind]),
+                map(int, self.judgment_inds[self.judgment_offsets[judgment_ind]:
+                                            self.judgment_offsets[judgment_ind + 1]]))
+
+    def get_answers(self, qa_ind):
+        """
+        Returns the answers of the given QA - the worker answer followed by all
+        validator answers, as lists of sentence indices.
+        """
+        judgments = [self.get_judgment(judgment_ind)
+                     for judgment_ind in range(3 * qa_ind, 3 * qa_ind + 3)]
+        return [inds
+                for (judge, status, inds) in judgments
+                if (status == ANSWER_JUDGMENT) and inds]
+
+    def iter_records(self):
+        """
+        Yields the records of this corpus in the same format as iter_tsv_records,
+        to be consumed by iter_indexed_sentences.
+        """
+        for sent_ind, sent_id in enumerate(self.sent_ids):
+            sentence_str = self.get_sentence(sent_ind)
+            for qa_ind in range(self.sent_qa_offsets[sent_ind],
+                                self.sent_qa_offsets[sent_ind + 1]):
+                question = self.get_tokens(self.question_tokens[self.question_offsets[qa_ind]:
+                                                                self.question_offsets[qa_ind + 1]])
+                yield (sent_id,
+                       sentence_str,
+                       self.workers[self.qa_worker[qa_ind]],
+                       int(self.qa_target[qa_ind]),
+                       question,
+                       self.get_answers(qa_ind))
+
+
+if __name__ == "__main__":
+    args = docopt(__doc__)
+    inp = args["--in"]
+    sents_fn = args["--sents"]
+    out = args["--out"]
+    logging.info("Compiling {} into {} ...".format(inp, out))
+    compile_corpus(inp, load_wiki_sentences(sents_fn), out)
+    logging.info("DONE!")
@@ -15,6 +15,7 @@ from pprint import pformat
 from pprint import pprint
 import pdb
 import itertools
+import nltk
 
 # Local imports
 from preproc import find_heads
@@ -23,12 +24,15 @@ from preproc import is_verb_tag
 from preproc import is_adverb_tag
 from preproc import enum
 from preproc import group_consecutive
-from spacy_wrapper import spacy_with_whitespace_tokenizer as spacy_ws
+from spacy_wrapper import parse_texts, close_parse_pool, PARSE_BATCH_SIZE
 from preproc import is_determiner_tag
 from preproc import is_prepositional_tag
 from preproc import is_modal_tag
 from preproc import is_wh_question
 from preproc import is_noun_tag
+from preproc import exact_align_phrase
+from preproc import format_alignment
+from preproc import iter_batches
 
 from qa_template_to_oie import NonterminalGenerator
 from qa_template_to_oie import OIE
@@ -45,7 +49,9 @@ class Sentence:
                  sentence_id):
         """
         sentence - tokenized sentence
-        pos_tags - corresponding pos tags
+        pos_tags - corresponding pos tags (None until the sentence is parsed, see parse_sentences)
+        The sentence's spaCy parse (tags, lemmas and dependencies) is kept in
+        sentence_spacy_parse, also set by parse_sentences.
         template_extractor - a Templateextractor instance to accumulate
                              templates across sentences
         """
@@ -55,7 +61,7 @@ class Sentence:
 
         self.sentence = sentence
         self.pos_tags = pos_tags
-
+        self.sentence_spacy_parse = None
 
         self.sentence_id = sentence_id
         self.sentence_str = " ".join(self.sentence)
@@ -308,14 +314,12 @@ class QA_pair:
     Container for raw and aligned QA pairs
     """
 
-    # Static spaCy parser instance
-    parser = spacy_ws.parser
-
     def __init__(self, worker_id, special_word, raw_question, raw_answer,
                  aligned_question, aligned_answer, pos_tags, sentence):
         """
         Initialize from the input file format
         pos_tags - pos tags from the original sentence
+        The question is parsed separately, see parse_sentences.
         """
         self.np_chunk_counter = 0
         self.vp_chunk_counter = 0
@@ -343,13 +347,8 @@ class QA_pair:
         self.chunks = {}
 
         ## Calculated fields
-        try:
-            self.question_spacy_parse = QA_pair.parser(unicode(self.raw_question_str))
-
-        except Exception as e:
-            # Some questions fail when decoding to unicode
-            # Store None as parse in those cases
-            self.question_spacy_parse = None
+        # Set in bulk by parse_sentences
+        self.question_spacy_parse = None
 
 #        self.template_question = self.extract_template()
 #        self.template_question_str = " ".join([word.source_word
@@ -1007,41 +1006,222 @@ class TemplateExtractor:
 
     #     return ordered_templates
 
-def load_sentences(fn):
+# Number of sentences which are collected and parsed together by iter_parsed_sentences
+PARSE_BLOCK_SIZE = 500
+
+def load_sentences(fn, batch_size = PARSE_BATCH_SIZE, n_process = 1):
+    """
+    Returns a list of (parsed) sentences as annotated in the input file
+    n_process - number of parsing processes, see spacy_wrapper.ParsePool
     """
-    Returns a list of sentences as annotated in the input file
+    sents = list(iter_sentences(fn))
+    try:
+        parse_sentences(sents, batch_size, n_process)
+    except:
+        # Don't leave parsing processes behind
+        close_parse_pool(terminate = True)
+        raise
+    finally:
+        if n_process > 1:
+            close_parse_pool()
+    return sents
+
+def parse_sentences(sents, batch_size = PARSE_BATCH_SIZE, n_process = 1):
+    """
+    Bulk parse phase - collect the texts of all of the given sentences and their questions,
+    run them through spaCy's batched pipeline, and attach the results: sentence parses
+    (sentence_spacy_parse), their POS tags (pos_tags) and question parses (question_spacy_parse).
+    Parses are kept as CompactParse instances, and the spaCy Docs are released.
+    Texts which can't be parsed (see spacy_wrapper.is_parsable) keep None as parse.
+    batch_size, n_process - see spacy_wrapper.parse_texts
+    """
+    question_texts = {}
+    for sent in sents:
+        for qa in sent.qa_pairs:
+            try:
+                question_texts[qa.raw_question_str] = unicode(qa.raw_question_str)
+            except Exception as e:
+                # Some questions fail when decoding to unicode
+                # These keep None as parse
+                pass
+
+    # Parse each distinct question once
+    raw_questions = question_texts.keys()
+    question_parses = dict(zip(raw_questions,
+                               parse_texts([question_texts[raw_question]
+                                            for raw_question in raw_questions],
+                                           batch_size = batch_size,
+                                           n_process = n_process)))
+
+    sentence_parses = parse_texts([unicode(sent.sentence_str,
+                                           encoding = 'utf8')
+                                   for sent in sents],
+                                  batch_size = batch_size,
+                                  n_process = n_process)
+
+    for sent, sentence_parse in zip(sents, sentence_parses):
+        sent.sentence_spacy_parse = sentence_parse
+        sent.pos_tags = [word.tag_
+                         for word in sentence_parse] \
+                         if sentence_parse is not None else None
+        for qa in sent.qa_pairs:
+            qa.pos_tags = sent.pos_tags
+            qa.question_spacy_parse = question_parses.get(qa.raw_question_str)
+
+def iter_parsed_sentences(sents, block_size = PARSE_BLOCK_SIZE,
+                          batch_size = PARSE_BATCH_SIZE, n_process = 1):
+    """
+    Lazily parse the given sentences (e.g., as yielded by iter_sentences),
+    with a bulk parse phase (see parse_sentences) for every block_size sentences.
+    """
+    for block in iter_batches(sents, block_size):
+        parse_sentences(block, batch_size, n_process)
+        for sent in block:
+            yield sent
+
+def iter_sentences(fn, chunksize = 10000):
+    """
+    Lazily yields the sentences annotated in the input file, one at a time.
+    Each sentence is consolidated and yielded as soon as its block ends.
+    The file is read in chunks of (at most) chunksize rows, so memory
+    doesn't grow with the size of the input.
+    Sentences aren't parsed, see iter_parsed_sentences.
     """
-    df = pd.read_csv(fn, names = ["WID", "special",
-                                  "raw_question", "raw_answer",
-                                  "aligned_question", "aligned_answer"])
-    ret = []
     cur_sent = None
     template_extractor = TemplateExtractor()
-    for row_index, row in df.iterrows():
-        if not(isinstance(row["raw_question"], basestring) and \
-               isinstance(row["raw_answer"], basestring)):
-            # This is a row introducing a new sentence
+    for df in pd.read_csv(fn, names = ["WID", "special",
+                                       "raw_question", "raw_answer",
+                                       "aligned_question", "aligned_answer"],
+                          chunksize = chunksize):
+        for row_index, row in df.iterrows():
+            if not(isinstance(row["raw_question"], basestring) and \
+                   isinstance(row["raw_answer"], basestring)):
+                # This is a row introducing a new sentence
+                if cur_sent:
+                    cur_sent.consolidate_qas()
+                    yield cur_sent
+
+                cur_sent = new_sentence(row["WID"],
+                                        template_extractor,
+                                        row["raw_question"]) # = Sentence id
+            else:
+                # This is a QA pair relating to a previously introduced sentence
+                cur_sent.add_qa_pair(row["WID"], row["special"],
+                                     row["raw_question"].split(" "), row["raw_answer"].split(" "),
+                                     row["aligned_question"].split(" "), row["aligned_answer"].split(" "))
+    if cur_sent:
+        cur_sent.consolidate_qas()
+        yield cur_sent # Yield the last sentence
+
+def load_wiki_sentences(sents_fn):
+    """
+    Returns a dictionary from sentence id to its (space tokenized) sentence,
+    as given in the released wiki-sentences.tsv file.
+    """
+    return dict([line.rstrip("\n").split("\t", 1)
+                 for line in open(sents_fn)])
+
+def is_index_judgment(judgment):
+    """
+    Returns True iff the given validator judgment is a list of sentence indices
+    (and not, e.g., "Invalid" or "Redundant-i")
+    """
+    return bool(judgment.split()) and \
+        all([ind.isdigit() for ind in judgment.split()])
+
+def parse_tsv_row(row):
+    """
+    Parse a row (list of fields) in the released QAMR tsv format
+    (data/{full,filtered}, see data/README.md).
+    Returns (sentence_id, worker_id, target_word_ind, question, answers), where
+    answers is a list of lists of sentence indices - the worker's answer, followed
+    by all validator answers which are given as indices.
+    """
+    sent_id, target_words, worker_id, qa_index, \
+        target_word_ind, question, answer, validator_1, validator_2 = row[: 9]
+    judgments = [answer] + [validator.split(':', 1)[1]
+                            for validator in [validator_1, validator_2]]
+    answers = [map(int, judgment.split())
+               for judgment in judgments
+               if is_index_judgment(judgment)]
+    return sent_id, worker_id, int(target_word_ind), question, answers
+
+def iter_tsv_sentences(fn, sents_dict):
+    """
+    Lazily yields the sentences annotated in a QAMR tsv file (data/{full,filtered}).
+    sents_dict - mapping from sentence id to its space tokenized sentence
+                 (see load_wiki_sentences)
+    """
+    return iter_indexed_sentences(iter_tsv_records(fn, sents_dict))
+
+def iter_tsv_records(fn, sents_dict):
+    """
+    Yields a record per row in a QAMR tsv file:
+    (sentence_id, sentence, worker_id, target_word_ind, tokenized question, answers)
+    See parse_tsv_row for details.
+    """
+    with open(fn) as fin:
+        for line in fin:
+            sent_id, worker_id, target_word_ind, question, answers = \
+                parse_tsv_row(line.rstrip("\n").split("\t"))
+            yield (sent_id, sents_dict[sent_id], worker_id, target_word_ind,
+                   nltk.word_tokenize(question), answers)
+
+def iter_indexed_sentences(records):
+    """
+    Lazily yields sentences from records, in which answers are given as sentence indices
+    (see iter_tsv_records). Records pertaining to the same sentence are assumed to be consecutive.
+    The answer indices are used as exact alignments. Questions are aligned by exact matching
+    of their (non stopword) tokens, which is a single linear pass.
+    Sentences aren't parsed, see iter_parsed_sentences.
+    """
+    cur_sent = None
+    template_extractor = TemplateExtractor()
+    for sent_id, sentence_str, worker_id, target_word_ind, question, answers in records:
+        if (cur_sent is None) or (sent_id != cur_sent.sentence_id):
+            # This is a record introducing a new sentence
             if cur_sent:
                 cur_sent.consolidate_qas()
-                ret.append(cur_sent)
+                yield cur_sent
 
-            pos_tags = [word.tag_
-                        for word
-                        in spacy_ws.parser(unicode(row["WID"],
-                                                   encoding = 'utf8'))]
+            cur_sent = new_sentence(sentence_str,
+                                    template_extractor,
+                                    sent_id)
 
-            cur_sent = Sentence(row["WID"].split(" "),
-                                pos_tags, # POS tags
-                                template_extractor,
-                                row["raw_question"]) # = Sentence id
-        else:
-            # This is a QA pair relating to a previously introduced sentence
-            cur_sent.add_qa_pair(row["WID"], row["special"],
-                                 row["raw_question"].split(" "), row["raw_answer"].split(" "),
-                                 row["aligned_question"].split(" "), row["aligned_answer"].split(" "))
-    cur_sent.consolidate_qas()
-    ret.append(cur_sent) # Append the last sentence
-    return ret
+        add_indexed_qa_pairs(cur_sent, worker_id, target_word_ind,
+                             question, answers)
+
+    if cur_sent:
+        cur_sent.consolidate_qas()
+        yield cur_sent # Yield the last sentence
+
+def new_sentence(sentence_str, template_extractor, sentence_id):
+    """
+    Returns a new (empty and unparsed) Sentence instance for the given space tokenized sentence.
+    """
+    return Sentence(sentence_str.split(" "),
+                    None,
+                    template_extractor,
+                    sentence_id)
+
+def add_indexed_qa_pairs(sent, worker_id, target_word_ind, question, answers):
+    """
+    Add a QA pair to the sentence for each of the given answers.
+    question - tokenized question
+    answers - list of lists of sentence indices
+    """
+    for answer_inds in answers:
+        raw_answer = [sent.sentence[ind] for ind in answer_inds]
+        question_align = exact_align_phrase(sent.sentence,
+                                            question,
+                                            excluded = set(answer_inds),
+                                            anchor = target_word_ind)
+        sent.add_qa_pair(worker_id,
+                         sent.sentence[target_word_ind],
+                         question,
+                         raw_answer,
+                         format_alignment(question, sent.sentence, question_align).split(" "),
+                         format_alignment(raw_answer, sent.sentence, answer_inds).split(" "))
 
 
 question_words = ["what",
@@ -0,0 +1,292 @@
+""" Usage:
+    fuzzy_matcher --in=EXPERIMENT_FILE [--limit=N]
+
+Check FuzzyMatcher against fuzzywuzzy's process.extract, matching each question
+and answer word against the sentence words of a tokenized experiment file.
+
+Options:
+    --limit=N  Number of choices to extract per word [default: 10]
+"""
+
+from docopt import docopt
+from collections import Counter, defaultdict
+import heapq
+import os
+import logging
+logging.basicConfig(level = logging.DEBUG)
+
+from fuzzywuzzy import fuzz, process
+from fuzzywuzzy.utils import full_process
+
+# Default score which matches need to exceed
+SCORE_CUTOFF = 70
+
+# WRatio's length ratios for switching to partial matching, see fuzz.WRatio
+PARTIAL_LEN_RATIO = 1.5
+LOW_PARTIAL_LEN_RATIO = 8
+
+# WRatio's scaling of partial matching scores
+PARTIAL_SCALE = .9
+LOW_PARTIAL_SCALE = .6
+
+
+def wratio_upper_bound(len1, len2, common):
+    """
+    Upper bound (before rounding) on fuzz.WRatio of two processed single token strings,
+    of lengths len1 and len2 which have common characters in common (as multisets).
+    Every SequenceMatcher ratio computed by WRatio is at most 2 * common / (total length),
+    where for partial matching the longer string is cut to a window of the shorter's length.
+    """
+    shorter, longer = min(len1, len2), max(len1, len2)
+    bound = 200.0 * common / (len1 + len2)
+    len_ratio = float(longer) / shorter
+    if len_ratio >= PARTIAL_LEN_RATIO:
+        scale = LOW_PARTIAL_SCALE if (len_ratio > LOW_PARTIAL_LEN_RATIO) \
+                else PARTIAL_SCALE
+        # Partial ratio is rounded before it is scaled
+        bound = max(bound,
+                    (200.0 * common / (shorter + common) + .5) * scale)
+    return bound
+
+
+class FuzzyMatcher:
+    """
+    Repeatedly extract the best fuzzy matches of words from a fixed list of choices.
+    Gives the same results as fuzzywuzzy's process.extract (with the default WRatio scorer),
+    restricted to matches scoring above a cutoff, while skipping choices which provably
+    can't pass it. These are found with an inverted index from characters to the choices
+    containing them, which bounds the number of characters a choice shares with the query.
+    """
+    def __init__(self, choices, processor, score_cutoff = SCORE_CUTOFF):
+        """
+        choices - list of strings to match against
+        processor - applied to the query and to each choice before scoring
+        score_cutoff - only matches scoring above this value are returned
+        """
+        self.choices = choices
+        self.processor = processor
+        self.score_cutoff = score_cutoff
+
+        # Intern the distinct processed choices
+        self.processed = []
+        self.choice_ids = []
+        processed_ids = {}
+        for choice in choices:
+            processed = full_process(processor(choice), force_ascii = True)
+            if processed not in processed_ids:
+                processed_ids[processed] = len(self.processed)
+                self.processed.append(processed)
+            self.choice_ids.append(processed_ids[processed])
+
+        # Map each character to the (id, count) of the single token processed choices containing it.
+        # Multi token choices can score high through token based ratios, and are always scored.
+        self.char_index = defaultdict(list)
+        self.multi_token_ids = []
+        for processed_id, processed in enumerate(self.processed):
+            if " " in processed:
+                self.multi_token_ids.append(processed_id)
+                continue
+            for char, count in Counter(processed).iteritems():
+                self.char_index[char].append((processed_id, count))
+
+    def get_candidates(self, processed_query):
+        """
+        Returns the ids of the processed choices which might score above the cutoff
+        """
+        if " " in processed_query:
+            return range(len(self.processed))
+
+        common = defaultdict(int)
+        for char, query_count in Counter(processed_query).iteritems():
+            for processed_id, count in self.char_index.get(char, []):
+                common[processed_id] += min(query_count, count)
+
+        return self.multi_token_ids + \
+            [processed_id
+             for processed_id, cur_common in common.iteritems()
+             if wratio_upper_bound(len(processed_query),
+                                   len(self.processed[processed_id]),
+                                   cur_common) >= self.score_cutoff + .5]
+
+    def score_all(self, query):
+        """
+        Returns a list of (index in choices, score) of all the choices
+        which score above the cutoff for query, in the order of choices.
+        """
+        processed_query = full_process(self.processor(query), force_ascii = True)
+        if not processed_query:
+            return []
+
+        scores = dict([(processed_id,
+                        fuzz.WRatio(processed_query, self.processed[processed_id],
+                                    full_process = False))
+                       for processed_id in self.get_candidates(processed_query)])
+
+        return [(choice_ind, scores[processed_id])
+                for choice_ind, processed_id in enumerate(self.choice_ids)
+                if scores.get(processed_id, 0) > self.score_cutoff]
+
+    def extract(self, query, limit):
+        """
+        Returns the indices (in choices) of the best limit matches for query,
+        which score above the cutoff, ordered by decreasing score.
+        """
+        return get_best_matches(self.score_all(query), limit)
+
+
+def get_best_matches(matches, limit):
+    """
+    Returns the indices of the limit highest scoring of the given
+    (index, score) matches. Ties keep their original order,
+    same as in process.extract (heapq.nlargest is stable).
+    """
+    return [ind
+            for (ind, score)
+            in heapq.nlargest(limit, matches, key = lambda (ind, score): score)]
+
+
+class NeighbourTable:
+    """
+    Corpus wide table of fuzzy neighbours - for each query word, all of the choice words
+    (e.g., sentence words) scoring above the cutoff, along with their scores.
+    Persisted to a tab separated file, with one of the following records per line:
+    - query <word> - a word in the query vocabulary
+    - choice <word> - a word in the choice vocabulary
+    - neighbour <query> <choice> <score> - an above cutoff pair
+    Adding vocabulary appends to the file, scoring only pairs involving new words.
+    """
+    def __init__(self, processor, fn = None, score_cutoff = SCORE_CUTOFF):
+        """
+        processor - applied to queries and choices before scoring, see FuzzyMatcher
+        fn - file to load the table from (if it exists) and to persist it to
+        score_cutoff - only neighbours scoring above this value are stored
+        """
+        self.processor = processor
+        self.fn = fn
+        self.score_cutoff = score_cutoff
+        self.neighbours = {}
+        self.choices = []
+        self.choice_set = set()
+        if (fn is not None) and os.path.exists(fn):
+            self.load()
+
+    def load(self):
+        """
+        Load the table from its file
+        """
+        with open(self.fn) as fin:
+            for line in fin:
+                record = line.rstrip("\n").split("\t")
+                if record[0] == "cutoff":
+                    if int(record[1]) != self.score_cutoff:
+                        raise Exception("{} was built with cutoff {}, expected {}".\
+                                        format(self.fn, record[1], self.score_cutoff))
+                elif record[0] == "query":
+                    self.neighbours[record[1]] = {}
+                elif record[0] == "choice":
+                    self.choices.append(record[1])
+                    self.choice_set.add(record[1])
+                elif record[0] == "neighbour":
+                    self.neighbours[record[1]][record[2]] = int(record[3])
+        logging.debug("Loaded {} queries and {} choices from {}".format(len(self.neighbours),
+                                                                        len(self.choices),
+                                                                        self.fn))
+
+    def add_vocabulary(self, queries, choices):
+        """
+        Add query and choice words to the table, scoring new queries against all choices,
+        and all old queries against new choices.
+        """
+        new_queries = sorted(set(queries) - set(self.neighbours))
+        new_choices = sorted(set(choices) - self.choice_set)
+        if not (new_queries or new_choices):
+            return
+
+        # Score old queries against the new choices
+        records = []
+        matcher = FuzzyMatcher(new_choices, self.processor, self.score_cutoff)
+        for query, scores in self.neighbours.iteritems():
+            for choice_ind, score in matcher.score_all(query):
+                scores[new_choices[choice_ind]] = score
+                records.append(["neighbour", query, new_choices[choice_ind], score])
+
+        self.choices.extend(new_choices)
+        self.choice_set.update(new_choices)
+
+        # Score new queries against all choices
+        matcher = FuzzyMatcher(self.choices, self.processor, self.score_cutoff)
+        for query in new_queries:
+            self.neighbours[query] = {}
+            for choice_ind, score in matcher.score_all(query):
+                self.neighbours[query][self.choices[choice_ind]] = score
+                records.append(["neighbour", query, self.choices[choice_ind], score])
+
+        logging.info("Added {} queries and {} choices to the neighbour table".format(len(new_queries),
+                                                                                    len(new_choices)))
+        if self.fn is not None:
+            with open(self.fn, 'a') as fout:
+                if fout.tell() == 0:
+                    fout.write("cutoff\t{}\n".format(self.score_cutoff))
+                for record in [["query", query] for query in new_queries] + \
+                              [["choice", choice] for choice in new_choices] + \
+                              records:
+                    fout.write("\t".join(map(str, record)) + "\n")
+
+    def get_matcher(self, choices):
+        """
+        Returns a matcher over choices which looks up the table,
+        or a FuzzyMatcher if some of the choices aren't in the table.
+        """
+        if all([choice in self.choice_set for choice in choices]):
+            return NeighbourMatcher(self, choices)
+        return FuzzyMatcher(choices, self.processor, self.score_cutoff)
+
+
+class NeighbourMatcher:
+    """
+    Same interface and results as FuzzyMatcher, looking up scores in a NeighbourTable
+    which contains all of the choices.
+    """
+    def __init__(self, table, choices):
+        """
+        table - NeighbourTable containing all of the choices
+        choices - list of strings to match against
+        """
+        self.table = table
+        self.choices = choices
+        self.fallback = None
+
+    def extract(self, query, limit):
+        """
+        Returns the indices (in choices) of the best limit matches for query,
+        falls back to fuzzy matching for queries which aren't in the table.
+        """
+        if query not in self.table.neighbours:
+            if self.fallback is None:
+                self.fallback = FuzzyMatcher(self.choices, self.table.processor, self.table.score_cutoff)
+            return self.fallback.extract(query, limit)
+
+        scores = self.table.neighbours[query]
+        return get_best_matches([(choice_ind, scores[choice])
+                                 for choice_ind, choice in enumerate(self.choices)
+                                 if choice in scores],
+                                limit)
+
+
+if __name__ == "__main__":
+    from preproc import iter_experiment_blocks, semi_process
+    args = docopt(__doc__)
+    limit = int(args["--limit"])
+    words = 0
+    for (sent_row, qa_rows) in iter_experiment_blocks(args["--in"]):
+        sentence = sent_row[0].split(" ")
+        matcher = FuzzyMatcher(sentence, semi_process)
+        for row in qa_rows:
+            for word in " ".join(row[2: 4]).split(" "):
+                expected = [choice for (choice, score)
+                            in process.extract(word, sentence, processor = semi_process, limit = limit)
+                            if score > SCORE_CUTOFF]
+                actual = [sentence[choice_ind] for choice_ind in matcher.extract(word, limit)]
+                assert actual == expected, (word, actual, expected)
+                words += 1
+    logging.info("Checked {} words".format(words))
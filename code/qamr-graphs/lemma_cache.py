@@ -0,0 +1,85 @@
+""" Usage:
+    lemma_cache --in=EXPERIMENT_FILE --out=LEMMA_FILE
+
+Pre-compute the lemmas of all words in a tokenized experiment file (for all WordNet POS),
+and add them to a lemma file which can be passed to align_exp --lemmas.
+"""
+
+from docopt import docopt
+from nltk.corpus.reader.wordnet import NOUN, VERB, ADJ, ADV
+import os
+import logging
+logging.basicConfig(level = logging.DEBUG)
+
+# The WordNet POS which words can be lemmatized with (see preproc.get_wordnet_pos)
+WORDNET_POS = [NOUN, VERB, ADJ, ADV]
+
+# Maximal number of (word, pos) lemmas to keep in memory
+MAX_LEMMA_CACHE_SIZE = 1000000
+
+
+class LemmaCache:
+    """
+    Memoize a lemmatizer by (word, WordNet POS), can be pre-warmed
+    with a vocabulary and serialized to a tab separated file of (word, pos, lemma).
+    """
+    def __init__(self, lemmatizer, fn = None, max_size = MAX_LEMMA_CACHE_SIZE):
+        """
+        lemmatizer - an object with a lemmatize(word, pos) method (e.g., WordNetLemmatizer)
+        fn - file to load lemmas from, if given. Never written to, unless calling save.
+        max_size - lemmas aren't memoized after reaching this number
+        """
+        self.lemmatizer = lemmatizer
+        self.fn = fn
+        self.max_size = max_size
+        self.lemmas = {}
+        if (fn is not None) and os.path.exists(fn):
+            for line in open(fn):
+                word, pos, lemma = line.rstrip("\n").split("\t")
+                self.lemmas[(word, pos)] = lemma
+            logging.debug("Loaded {} lemmas from {}".format(len(self.lemmas), fn))
+
+    def lemmatize(self, word, pos):
+        """
+        Returns the lemma of word with the given WordNet POS
+        """
+        key = (word, pos)
+        if key in self.lemmas:
+            return self.lemmas[key]
+        lemma = self.lemmatizer.lemmatize(word, pos)
+        if len(self.lemmas) < self.max_size:
+            self.lemmas[key] = lemma
+        return lemma
+
+    def warm(self, words):
+        """
+        Lemmatize all words with every WordNet POS, and then re-lemmatize the
+        resulting lemmas, as done when aligning against lemmatized sentences.
+        """
+        lemmas = set([self.lemmatize(word, pos)
+                      for word in set(words)
+                      for pos in WORDNET_POS])
+        for lemma in lemmas:
+            for pos in WORDNET_POS:
+                self.lemmatize(lemma, pos)
+
+    def save(self, fn = None):
+        """
+        Write all lemmas to fn (defaults to the file this cache was loaded from)
+        """
+        fn = fn if fn is not None else self.fn
+        with open(fn, 'w') as fout:
+            for (word, pos), lemma in self.lemmas.iteritems():
+                fout.write("{}\t{}\t{}\n".format(word, pos, lemma))
+        self.fn = fn
+        logging.debug("Saved {} lemmas to {}".format(len(self.lemmas), fn))
+
+
+if __name__ == "__main__":
+    from preproc import Aligner
+    args = docopt(__doc__)
+    out = args["--out"]
+    aligner = Aligner(lemma_cache_fn = out)
+    aligner.warm_lemmas(args["--in"])
+    aligner.lemmas.save()
+    logging.info("DONE!")
@@ -0,0 +1,103 @@
+""" Usage:
+    parse_cache --cache=CACHE_FILE
+
+Print statistics of an on-disk cache of spaCy parses (see chunk --parse-cache).
+"""
+
+from docopt import docopt
+import base64
+import hashlib
+import os
+import logging
+logging.basicConfig(level = logging.DEBUG)
+
+# Mixed into all keys - bump whenever the serialization of parses changes,
+# to invalidate previously cached parses
+PARSE_CACHE_VERSION = 2
+
+
+def get_parse_key(text, model_version, components):
+    """
+    Returns a content hash of a parse - the (unicode) parsed text,
+    the model which parsed it (see spacy_wrapper.get_model_version),
+    and the requested pipeline components.
+    """
+    return hashlib.sha1("\n".join([str(PARSE_CACHE_VERSION),
+                                   model_version,
+                                   " ".join(components),
+                                   text.encode("utf8")])).hexdigest()
+
+
+class ParseCache:
+    """
+    On-disk cache of serialized parses (JSON of compact_parse.get_fields), keyed by get_parse_key.
+    Stored as a tab separated file of (key, base64 encoded parse), new parses are appended
+    as they're added. Only the byte offsets of the parses are kept in memory, and each parse
+    is read from disk when it's requested.
+    """
+    def __init__(self, fn):
+        """
+        fn - file to load the cache from (if it exists) and to append new parses to
+        """
+        self.fn = fn
+        self.offsets = {}
+        self.hits = 0
+        self.misses = 0
+        self.fin = None
+        self.fout = None
+        self.dirty = False
+        if os.path.exists(fn):
+            with open(fn, 'rb') as fin:
+                start = 0
+                for line in fin:
+                    self.offsets[line.split("\t", 1)[0]] = start
+                    start += len(line)
+            logging.debug("Loaded {} parses from {}".format(len(self.offsets), fn))
+
+    def get(self, key):
+        """
+        Returns the cached parse (serialized) of key, or None if it isn't in the cache.
+        Counts hits and misses.
+        """
+        if key not in self.offsets:
+            self.misses += 1
+            return None
+        self.hits += 1
+        if self.dirty:
+            # Make appended parses readable
+            self.fout.flush()
+            self.dirty = False
+        if self.fin is None:
+            self.fin = open(self.fn, 'rb')
+        self.fin.seek(self.offsets[key])
+        return base64.b64decode(self.fin.readline().rstrip("\n").split("\t")[1])
+
+    def add(self, key, data):
+        """
+        Add a serialized parse to the cache
+        """
+        if key in self.offsets:
+            return
+        if self.fout is None:
+            self.fout = open(self.fn, 'ab')
+            self.fout.seek(0, os.SEEK_END)
+        self.offsets[key] = self.fout.tell()
+        self.fout.write("{}\t{}\n".format(key, base64.b64encode(data)))
+        self.dirty = True
+
+    def close(self):
+        """
+        Flush new parses to disk, and close the cache file
+        """
+        for f in [self.fin, self.fout]:
+            if f is not None:
+                f.close()
+        self.fin = None
+        self.fout = None
+        self.dirty = False
+
+
+if __name__ == "__main__":
+    args = docopt(__doc__)
+    cache = ParseCache(args["--cache"])
+    print "{} cached parses".format(len(cache.offsets))
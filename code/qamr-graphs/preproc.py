@@ -15,16 +15,26 @@ from nltk.corpus import stopwords, wordnet
 from nltk.stem.wordnet import WordNetLemmatizer
 import logging
 logging.basicConfig(level = logging.DEBUG)
-from fuzzywuzzy import process
 from fuzzywuzzy.utils import full_process
 from fuzzywuzzy.string_processing import StringProcessor
-from solvers import discrete_brute_minimizer, mean_distance_from_centroid
+from fuzzy_matcher import FuzzyMatcher, NeighbourTable
+from alignment_cache import AlignmentCache, get_alignment_key
+from lemma_cache import LemmaCache
+from batches import iter_batches, imap_batches
+from solvers import discrete_brute_minimizer, discrete_minimizer, discrete_greedy_minimizer, \
+    mean_distance_from_centroid, BudgetExceeded
 from operator import itemgetter
 from pandas import Series
 from copy import copy
 import string
+import re
+import csv
+import os
+import time
+from contextlib import closing
 from fuzzywuzzy.utils import asciidammit
 from itertools import groupby
+from collections import defaultdict
 from operator import itemgetter
 
 
@@ -74,79 +84,297 @@ def graph_to_triples(digraph, sent):
                                 " ".join(sent[v[0]: v[1]]))
             for (u, v) in digraph.edges()]
 
-def tokenize_experiment(exp_fn, out_fn):
+def tokenize_experiment(exp_fn, out_fn, jobs = 1):
     """
     Tokenizes the sentences and phrases in a given experiment file
     outputs the tokenized version into out_fn
+    Streams the rows, so memory doesn't depend on the input size.
+    jobs - number of worker processes to tokenize with, output is written in the original order.
+    """
+    with open(exp_fn) as fin, open(out_fn, 'w') as fout:
+        reader = csv.reader(fin)
+        writer = csv.writer(fout, lineterminator = '\n')
+        if jobs > 1:
+            # Send rows to workers in chunks
+            with closing(imap_batches(tokenize_rows,
+                                      iter_batches(reader, TOKENIZE_CHUNK_SIZE),
+                                      jobs, TOKENIZE_BATCH_SIZE)) as tokenized_chunks:
+                for rows in tokenized_chunks:
+                    writer.writerows(rows)
+        else:
+            writer.writerows(itertools.imap(tokenize_row, reader))
+
+def tokenize_row(row):
+    """
+    Tokenize all fields of an experiment file row
     """
-    df = pd.read_csv(exp_fn, header = None)
-    for i in df:
-        # Iterate over all fields and tokenize strings
-        df[i] = [" ".join(nltk.word_tokenize(s if isinstance(s, basestring) else "")) for s in df[i]]
+    return [" ".join(nltk.word_tokenize(s)) for s in row]
 
-    # Write to output file
-    df.to_csv(out_fn, header = False, index = False)
+def tokenize_rows(rows):
+    """
+    Tokenize a chunk of experiment file rows in a worker process
+    """
+    return map(tokenize_row, rows)
+
+def iter_experiment_blocks(exp_fn):
+    """
+    Lazily reads an experiment file (csv of worker id, special word, question, answer),
+    and yields (sentence row, list of QA rows) for each sentence block.
+    A sentence block starts with a row which has no QA pair, with the sentence in its first field.
+    QA rows may have a fifth field, with the (space separated) sentence indices of the answer
+    (see convert_dropbox --use_indices). All rows are padded to five fields.
+    """
+    sent_row = None
+    qa_rows = []
+    with open(exp_fn) as fin:
+        for row in csv.reader(fin):
+            answer_indices = row[4] if (len(row) == 5) else ""
+            row = (row + [""] * 4)[: 4] + [answer_indices]
+            if not (row[2] and row[3]):
+                # This is a row introducing a new sentence
+                if sent_row is not None:
+                    yield sent_row, qa_rows
+                sent_row = row
+                qa_rows = []
+            else:
+                # This is a QA pair relating to the current sentence
+                qa_rows.append(row)
+
+    if sent_row is not None:
+        yield sent_row, qa_rows
 
 class Aligner:
     """
     Perform QA-SRL alignments between QA pairs and the original sentence
     """
 
-    def __init__(self):
+    def __init__(self, neighbours = None, alignment_cache = None, lemma_cache_fn = None,
+                 max_assignments = None, time_limit = None):
         """
         Initialize class members:
         - lematizer
+        - neighbours - an optional NeighbourTable for looking up fuzzy matches
+        - alignment_cache - an optional AlignmentCache of previously aligned QAs.
+          Worker processes (align_experiment with jobs > 1) only see its state from before the run.
+        - lemma_cache_fn - an optional file of pre-computed lemmas (see LemmaCache)
+        - max_assignments, time_limit - optional budget for aligning each QA, in number of
+          possible assignments of a phrase, and in seconds. QAs exceeding it are aligned greedily.
         """
         self.lmtzr = WordNetLemmatizer()
+        self.lemmas = LemmaCache(self.lmtzr, lemma_cache_fn)
+        self.neighbours = neighbours
+        self.alignment_cache = alignment_cache
+        self.max_assignments = max_assignments
+        self.time_limit = time_limit
+
+        # Whether the last aligned QA exceeded the budget
+        self.used_fallback = False
+
+        # QA rows which exceeded the budget, see align_experiment
+        self.fallbacks = []
 
-    def align_experiment(self, exp_fn, out_fn):
+    def warm_lemmas(self, exp_fn):
+        """
+        Pre-compute the lemmas of all words in the given *tokenized* experiment file
+        """
+        words = set()
+        for (sent_row, qa_rows) in iter_experiment_blocks(exp_fn):
+            words.update(sent_row[0].split(" "))
+            for (wid, special, question, answer, answer_indices) in qa_rows:
+                words.update(question.split(" "))
+                words.update(answer.split(" "))
+
+        # Lemmatized words go through the same processing as in safe_pos_tag
+        self.lemmas.warm([(w if w \
+                           else " ")
+                          for w in map(asciidammit,
+                                       words)])
+
+    def update_neighbours(self, exp_fn):
+        """
+        Add the vocabulary of the given *tokenized* experiment file to the neighbour table,
+        only words which aren't already in the table get scored.
+        """
+        queries = set()
+        choices = set()
+        for (sent_row, qa_rows) in iter_experiment_blocks(exp_fn):
+            block_queries, block_choices = self.get_block_vocabulary(sent_row, qa_rows)
+            queries.update(block_queries)
+            choices.update(block_choices)
+        self.neighbours.add_vocabulary(queries, choices)
+
+    def get_block_vocabulary(self, sent_row, qa_rows):
+        """
+        Returns the words which align_block would fuzzy match in a sentence block,
+        as a set of query (QA) words and a set of choice (sentence) words.
+        """
+        sent_index = SentenceAlignmentIndex(self, sent_row[0].split(" "), lemmatize = True)
+        choices = set(sent_index.words + sent_index.question_word_index.words)
+        queries = set()
+        for (wid, special, question, answer, answer_indices) in qa_rows:
+            question = self.lemmatize_phrase(question.split(" "))
+            queries.update(self.lemmatize_phrase(answer.split(" ")))
+            queries.update(self.lemmatize_phrase(question))
+        return queries, choices
+
+    def align_experiment(self, exp_fn, out_fn, jobs = 1):
         """
         Aligns the QAs with the sentences in a given *tokenized* experiment file
         outputs the aligned version into out_fn
+        Streams one sentence block at a time, so memory doesn't depend on the input size.
+        jobs - number of worker processes to align with (sentence blocks are independent),
+               output is written in the original order.
+        If the aligner has a budget, QAs which exceeded it are listed (sentence, worker id, question, answer)
+        in out_fn + FALLBACKS_EXT.
         """
-        df = pd.read_csv(exp_fn,
-                         names = ["WID", "special", "question", "answer"],
-                         header = None
-        )
-        df["aligned_question"] = Series([""] * len(df["WID"]))
-        df["aligned_answer"] = Series([""] * len(df["WID"]))
-        cur_sent = None
-        for row_index, row in df.iterrows():
-            if not(isinstance(row["question"], basestring) and \
-                   isinstance(row["answer"], basestring)):
-                # This is a row introducing a new sentence
-                cur_sent = row["WID"].split(" ")
-
-                # Add POS data to output sentence as the second value
-                df.set_value(row_index,
-                             "special",
-                             " ".join([pos
-                                       for (w, pos)
-                                       in safe_pos_tag(cur_sent)]))
+        blocks = iter_experiment_blocks(exp_fn)
+        worker_results = None
+        if jobs > 1:
+            worker_results = imap_batches(align_block_worker, blocks, jobs, ALIGN_BATCH_SIZE,
+                                          initializer = init_align_worker,
+                                          initargs = (self.neighbours.fn if self.neighbours is not None else None,
+                                                      self.alignment_cache.fn if self.alignment_cache is not None else None,
+                                                      self.lemmas.fn,
+                                                      self.max_assignments,
+                                                      self.time_limit))
+            aligned_blocks = (self.merge_worker_result(aligned_rows, cache_updates, fallbacks)
+                              for (aligned_rows, cache_updates, fallbacks) in worker_results)
+        else:
+            aligned_blocks = (self.align_block(sent_row, qa_rows)
+                              for (sent_row, qa_rows) in blocks)
+
+        has_budget = (self.max_assignments is not None) or (self.time_limit is not None)
+        num_of_fallbacks = 0
+        try:
+            with open(out_fn, 'w') as fout, \
+                 open(out_fn + FALLBACKS_EXT if has_budget else os.devnull, 'w') as fallbacks_fout:
+                writer = csv.writer(fout, lineterminator = '\n')
+                fallbacks_writer = csv.writer(fallbacks_fout, lineterminator = '\n')
+                for aligned_rows in aligned_blocks:
+                    writer.writerows(aligned_rows)
+                    fallbacks_writer.writerows(self.fallbacks)
+                    num_of_fallbacks += len(self.fallbacks)
+                    self.fallbacks = []
+        finally:
+            if worker_results is not None:
+                # Stops the workers, if writing stopped before all blocks were aligned
+                worker_results.close()
+
+        if has_budget:
+            logging.info("{} QAs exceeded the alignment budget, see {}".format(num_of_fallbacks,
+                                                                               out_fn + FALLBACKS_EXT))
+
+        if self.alignment_cache is not None:
+            self.alignment_cache.close()
+            logging.info("Alignment cache: {} hits, {} misses".format(self.alignment_cache.hits,
+                                                                      self.alignment_cache.misses))
+
+    def merge_worker_result(self, aligned_rows, cache_updates, fallbacks):
+        """
+        Record the alignment cache updates and the fallback QA rows of a worker process
+        (see align_block_worker), returns its aligned rows.
+        """
+        if cache_updates is not None:
+            self.alignment_cache.merge_updates(cache_updates)
+        self.fallbacks.extend(fallbacks)
+        return aligned_rows
 
+    def align_block(self, sent_row, qa_rows):
+        """
+        Align a single sentence block - a row introducing the sentence followed by
+        rows of QA pairs relating to it.
+        Returns the aligned output rows, QAs which exceeded the budget are added to self.fallbacks.
+        """
+        cur_sent = sent_row[0].split(" ")
+
+        # Find the QAs which aren't in the alignment cache
+        qas = []
+        for (wid, special, question, answer, answer_indices) in qa_rows:
+            cur_question = question.split(" ")
+            cur_answer = answer.split(" ")
+            # Answers given as sentence indices don't need to be aligned
+            given_answer_align = map(int, answer_indices.split()) if answer_indices \
+                                 else None
+            key = None
+            if self.alignment_cache is not None:
+                key = get_alignment_key(cur_sent, cur_question, cur_answer, True,
+                                        answer_alignment = given_answer_align)
+            qas.append((wid, special, question, answer, cur_question, cur_answer, given_answer_align,
+                        key))
+
+        # POS tag the sentence and all QAs which need to be aligned in bulk
+        self.pos_tag_block(cur_sent,
+                           [(cur_question, ) if given_answer_align is not None \
+                            else (cur_question, cur_answer)
+                            for (_, _, _, _, cur_question, cur_answer, given_answer_align, key) in qas
+                            if (key is None) or (key not in self.alignment_cache)])
+
+        # Precompute sentence lookups once, for all of the QAs in this block
+        # which aren't found in the alignment cache
+        sent_index = None
+
+        # Add POS data to output sentence as the second value
+        ret = [[sent_row[0],
+                " ".join([pos
+                          for (w, pos)
+                          in safe_pos_tag(cur_sent)]),
+                "", "", "", ""]]
+
+        for (wid, special, question, answer, cur_question, cur_answer, given_answer_align,
+             key) in qas:
+            # Align each QA pair with the sentence, looking it up just before, so that
+            # QAs repeated within the block are aligned only once
+            cached = self.alignment_cache.get(key) if key is not None \
+                     else None
+            if cached is not None:
+                question_align, answer_align = cached
             else:
-                # This is a QA pair relating to a previously introduced sentence
-                # Align it and write to df
-                cur_question = row["question"].split(" ")
-                cur_answer = row["answer"].split(" ")
+                if sent_index is None:
+                    sent_index = SentenceAlignmentIndex(self, cur_sent, lemmatize = True)
                 question_align, answer_align = self.align_qa(cur_sent,
                                                              cur_question,
                                                              cur_answer,
-                                                             lemmatize = True
+                                                             lemmatize = True,
+                                                             sent_index = sent_index,
+                                                             answer_alignment = given_answer_align
                 )
-                df.set_value(row_index, 'aligned_question', format_alignment(cur_question, cur_sent, question_align))
-                df.set_value(row_index, 'aligned_answer', format_alignment(cur_answer, cur_sent, answer_align))
+                if self.used_fallback:
+                    # Don't cache approximate alignments
+                    self.fallbacks.append([sent_row[0], wid, question, answer])
+                elif key is not None:
+                    self.alignment_cache.add(key, (question_align, answer_align))
+            ret.append([wid, special, question, answer,
+                        format_alignment(cur_question, cur_sent, question_align),
+                        format_alignment(cur_answer, cur_sent, answer_align)])
+        return ret
 
-        # Write to output file
-        df.to_csv(out_fn, header = False, index = False)
+    def pos_tag_block(self, sentence, qas):
+        """
+        POS tag (see pos_tag_phrases) all of the phrases which align_qa will tag,
+        for a sentence and a list of its (question, answer) pairs, in two batches:
+        the surface phrases, followed by the lemmatized phrases which get re-tagged.
+        The answer may be omitted from a pair, if it doesn't need aligning.
+        """
+        pos_tag_phrases([sentence] + [phrase
+                                      for qa in qas
+                                      for phrase in qa])
+        if qas:
+            pos_tag_phrases([self.lemmatize_phrase(sentence)] + \
+                            [self.lemmatize_phrase(qa[0])
+                             for qa in qas])
 
     def align_qa(self, sentence, question, answer,
-                 lemmatize):
+                 lemmatize, sent_index = None, answer_alignment = None):
         """
         Grounds a QA against the sentence using fuzzy matching (all tokenized strings in lists)
         Returns QA pair as a list of indices aligning with the sentence (or -1 if not found in the sentence)
         Assumes each word in the sentence can appear only once in the QA.
         lemmatize - whether to perform matching on lemmas instead of surface words
+        sent_index - a SentenceAlignmentIndex of the sentence, can be shared between all QAs
+                     of the same sentence. Computed if not given.
+        answer_alignment - the sentence indices of the answer, if they're known in advance.
+                           In which case only the question is aligned.
+        Sets self.used_fallback if the QA exceeded the budget, and was aligned greedily.
         """
         ## Start with the answer for several reasons:
         ## 1. Should align more easily - all of the words in the answer? (what to do if not?) That's why we include
@@ -154,45 +382,60 @@ class Aligner:
         ## 2. Hopefully there's a true alignemnt available in the annotation
         ## 3. Probably longer than the answer?
 
+        self.used_fallback = False
+        deadline = (time.time() + self.time_limit) if self.time_limit is not None \
+                   else None
+
+        if sent_index is None:
+            sent_index = SentenceAlignmentIndex(self, sentence, lemmatize)
+
         # Lemmatize all elements if indicated
+        sentence = sent_index.words
+        given_answer_alignment = answer_alignment is not None
         if lemmatize:
-            sentence = self.lemmatize_phrase(sentence)
             question = self.lemmatize_phrase(question)
-            answer = self.lemmatize_phrase(answer)
+            if not given_answer_alignment:
+                answer = self.lemmatize_phrase(answer)
 
-        answer_alignment = self.align_phrase(sentence, answer, align_stopwords = False)
+        if not given_answer_alignment:
+            answer_alignment = self.align_phrase(sentence, answer, align_stopwords = False,
+                                                 index = sent_index.word_index,
+                                                 deadline = deadline)
 
         # Store sentence without the words already aligned with the answer, while recording the original indices
-        sent_wo_answer = [(i, w) for i, w in enumerate(self.lemmatize_phrase(sentence)
-                                                       if lemmatize else sentence)
-                          if i not in answer_alignment]
-        map_to_sent = map(itemgetter(0), sent_wo_answer)
+        question_index, map_to_sent = sent_index.question_word_index.exclude(answer_alignment)
 
         # Align the question to this version of the sentence and alignemnt to indices in the original sentence
         question_alignment = [map_to_sent[i] if (i >= 0) else i
                               for i in
-                              self.align_phrase(map(itemgetter(1),
-                                                    sent_wo_answer),
+                              self.align_phrase(question_index.words,
                                                 self.lemmatize_phrase(question) if lemmatize else question,
-                                                align_stopwords = False
+                                                align_stopwords = False,
+                                                index = question_index,
+                                                deadline = deadline
                               )]
 
         # Try to greedily add stopwords
-        answer_alignment = self.extend_alignment(sentence, answer, answer_alignment)
+        if not given_answer_alignment:
+            answer_alignment = self.extend_alignment(sentence, answer, answer_alignment)
 
         return question_alignment, answer_alignment
 
     def lemmatize_phrase(self, phrase):
         """ Return a lemmatized version of the tokenized input phrase """
-        return [self.lmtzr.lemmatize(w, get_wordnet_pos(pos))
+        return [self.lemmas.lemmatize(w, get_wordnet_pos(pos))
                 for (w, pos) in safe_pos_tag(phrase)]
 
-    def align_phrase(self, sentence, phrase, align_stopwords):
+    def align_phrase(self, sentence, phrase, align_stopwords, index = None, deadline = None):
         """
         Grounds a phrase against the sentence using fuzzy matching (both tokenized strings)
         Returns a list of indices aligning with the sentence (or a negative if not found in the sentence)
         Assumes each word in the sentence can appear only once in the phrase.
         align_stopwords - contorls whether to align english stopwords (and punctuation)
+        index - an optional (precomputed) WordIndex of the sentence
+        deadline - optional time.time() by which the search should end
+        If the search exceeds self.max_assignments or the deadline, an approximate
+        greedy alignment is returned, and self.used_fallback is set.
         """
         # Words to ignore while aligning
         ignore_word = is_extended_stop_word \
@@ -205,19 +448,26 @@ class Aligner:
         ret = [-1] * len(phrase)
 
         # For each word in the phrase, find all words in the sentence which are close enough to it
-        possible_indices = [(i, fuzzy_match_word(w, sentence, limit, include_stopwords = align_stopwords))
+        possible_indices = [(i, fuzzy_match_word(w, sentence, limit, include_stopwords = align_stopwords,
+                                                 index = index))
                             for i, w in enumerate(phrase)
                             if (not ignore_word(w.lower()))]
         non_empty = [(i, x) for i, x in possible_indices if x]
 
         # Find an assignment which minimizes some density function, only for words with non-empty alignments
-        ass = discrete_brute_minimizer([opts + ([-1 * len(sentence)]
-                                                if contained_in_others(opts,
-                                                                       [ls for (i, ls) in non_empty
-                                                                        if i != word_ind])
-                                                else []) # Add a "don't map option" in case of duplicates
-                                        for word_ind, opts in non_empty],
-                                       func = mean_distance_from_centroid)[0]
+        possible_vals = [opts + ([-1 * len(sentence)]
+                                 if contained_in_others(opts,
+                                                        [ls for (i, ls) in non_empty
+                                                         if i != word_ind])
+                                 else []) # Add a "don't map option" in case of duplicates
+                         for word_ind, opts in non_empty]
+        try:
+            ass = discrete_minimizer(possible_vals,
+                                     max_assignments = self.max_assignments,
+                                     deadline = deadline)[0]
+        except BudgetExceeded:
+            ass = discrete_greedy_minimizer(possible_vals)[0]
+            self.used_fallback = True
 
         # Map back to words in the sentence
         for ind, val in zip(map(itemgetter(0), non_empty),
@@ -255,6 +505,156 @@ class Aligner:
                         pass
         return ret
 
+class WordIndex:
+    """
+    Precomputed lookups over a list of words, for repeatedly matching phrases against it
+    """
+    def __init__(self, words, stopword_flags = None, neighbours = None):
+        """
+        words - list of words
+        stopword_flags - whether each word is an (extended) stopword, computed if not given
+        neighbours - an optional NeighbourTable for looking up fuzzy matches
+        """
+        self.words = words
+        self.neighbours = neighbours
+        self.stopword_flags = stopword_flags if stopword_flags is not None \
+                              else [is_extended_stop_word(w.lower()) for w in words]
+
+        # Map from word to its positions
+        self.positions = defaultdict(list)
+        for i, w in enumerate(words):
+            self.positions[w].append(i)
+
+        # Words which can be fuzzy matched when stopwords are excluded
+        self.non_stopwords = [w for (w, is_stop) in zip(words, self.stopword_flags)
+                              if not is_stop]
+
+        # Fuzzy matchers, built on first use
+        self.matchers = {}
+
+    def get_matcher(self, include_stopwords):
+        """
+        Returns a fuzzy matcher over all words if include_stopwords is set,
+        otherwise over the non stopwords.
+        """
+        if include_stopwords not in self.matchers:
+            choices = self.words if include_stopwords \
+                      else self.non_stopwords
+            self.matchers[include_stopwords] = self.neighbours.get_matcher(choices) \
+                                               if self.neighbours is not None \
+                                               else FuzzyMatcher(choices, processor = semi_process)
+        return self.matchers[include_stopwords]
+
+    def exclude(self, excluded):
+        """
+        Returns a WordIndex over the words whose index isn't in excluded,
+        and a list mapping its indices back to indices in this index.
+        """
+        map_to_orig = [i for i in range(len(self.words))
+                       if i not in excluded]
+        return WordIndex([self.words[i] for i in map_to_orig],
+                         [self.stopword_flags[i] for i in map_to_orig],
+                         self.neighbours), \
+                         map_to_orig
+
+
+class SentenceAlignmentIndex:
+    """
+    Sentence level data needed for aligning QAs, computed once per sentence
+    and shared across all of its QAs.
+    """
+    def __init__(self, aligner, sentence, lemmatize):
+        """
+        aligner - Aligner instance (used for lemmatization)
+        sentence - tokenized sentence
+        lemmatize - whether to match against lemmas instead of surface words
+        """
+        # The words against which answers are matched
+        self.words = aligner.lemmatize_phrase(sentence) if lemmatize \
+                     else sentence
+        self.word_index = WordIndex(self.words, neighbours = aligner.neighbours)
+
+        # Questions are matched against a re-lemmatized version of the sentence
+        self.question_word_index = WordIndex(aligner.lemmatize_phrase(self.words),
+                                             neighbours = aligner.neighbours) if lemmatize \
+                                   else self.word_index
+
+
+def exact_align_phrase(sentence, phrase, excluded, anchor):
+    """
+    Grounds a phrase against the sentence using exact (case insensitive) matching only.
+    Returns a list of indices aligning with the sentence (or -1 if not found in the sentence)
+    Stopwords are not aligned, and each word in the sentence can appear only once in the phrase.
+    excluded - sentence indices which can't be aligned (e.g., already used by the answer)
+    anchor - sentence index used to break ties between multiple occurrences (the closest is chosen)
+    """
+    positions = defaultdict(list)
+    for i, w in enumerate(sentence):
+        if i not in excluded:
+            positions[w.lower()].append(i)
+
+    used = set()
+    ret = []
+    for w in phrase:
+        opts = [i for i in positions.get(w.lower(), [])
+                if i not in used]
+        if (not opts) or is_extended_stop_word(w.lower()):
+            ret.append(-1)
+            continue
+        ind = min(opts, key = lambda i: abs(i - anchor))
+        used.add(ind)
+        ret.append(ind)
+    return ret
+
+# Number of sentence blocks sent to each alignment worker at a time
+ALIGN_BATCH_SIZE = 8
+
+# Number of rows tokenized in each worker task, and number of tasks per worker in a batch
+TOKENIZE_CHUNK_SIZE = 64
+TOKENIZE_BATCH_SIZE = 8
+
+# Extension of the file listing the QAs which exceeded the alignment budget
+FALLBACKS_EXT = ".fallbacks"
+
+# The aligner of the current worker process (see init_align_worker)
+worker_aligner = None
+
+def init_align_worker(neighbours_fn, alignment_cache_fn, lemma_cache_fn,
+                      max_assignments, time_limit):
+    """
+    Pool initializer - create a single aligner per worker process,
+    and load WordNet (which is lazily loaded by nltk) before the first alignment.
+    neighbours_fn - the file of the parent's NeighbourTable, if it has one
+    alignment_cache_fn - the file of the parent's AlignmentCache, if it has one.
+                         Opened read only, new alignments are sent back to the parent.
+    lemma_cache_fn - the file of the parent's LemmaCache, if it has one (never written by workers)
+    max_assignments, time_limit - the parent's alignment budget
+    """
+    global worker_aligner
+    worker_aligner = Aligner(neighbours = NeighbourTable(semi_process, neighbours_fn) \
+                             if neighbours_fn is not None else None,
+                             alignment_cache = AlignmentCache(alignment_cache_fn, read_only = True) \
+                             if alignment_cache_fn is not None else None,
+                             lemma_cache_fn = lemma_cache_fn,
+                             max_assignments = max_assignments,
+                             time_limit = time_limit)
+    worker_aligner.lmtzr.lemmatize("loading")
+
+def align_block_worker(block):
+    """
+    Align a single sentence block (sentence row, qa rows) in a worker process.
+    Returns the aligned rows, the alignment cache updates (or None if there's no cache),
+    and the QA rows which exceeded the alignment budget.
+    """
+    sent_row, qa_rows = block
+    aligned_rows = worker_aligner.align_block(sent_row, qa_rows)
+    fallbacks = worker_aligner.fallbacks
+    worker_aligner.fallbacks = []
+    return (aligned_rows,
+            worker_aligner.alignment_cache.pop_updates() if worker_aligner.alignment_cache is not None \
+            else None,
+            fallbacks)
+
 def contained_in_others(ls, others):
     """
     Identifies whether all of the elements in ls are contained in the lists
@@ -262,34 +662,46 @@ def contained_in_others(ls, others):
     """
     return all(any([elem in other_ls for other_ls in others]) for elem in ls)
 
+# Matches strings made only of punctuation (including the empty string)
+PUNCTUATION_REGEX = re.compile("[{}]*\\Z".format(re.escape(string.punctuation)))
+
+# English stopwords, loaded from nltk on first use
+english_stopwords = None
+
+# Memoized verdicts of is_extended_stop_word
+stop_word_verdicts = {}
+
 def is_extended_stop_word(word):
     """
     Identify whether a word is a stopword in a slightly extended sense, which includes:
     - punctuation
     - contractions
     """
-    return True if \
-        word.startswith("'") \
-        or (word in stopwords.words('english'))\
-        or (all([w in string.punctuation for w in list(word)]))\
-        else False
+    global english_stopwords
+    if word not in stop_word_verdicts:
+        if english_stopwords is None:
+            english_stopwords = frozenset(stopwords.words('english'))
+        stop_word_verdicts[word] = word.startswith("'") \
+                                   or (word in english_stopwords) \
+                                   or (PUNCTUATION_REGEX.match(word) is not None)
+    return stop_word_verdicts[word]
 
 def fuzzy_match_word(word, words, limit,
-                     include_stopwords = False):
+                     include_stopwords = False,
+                     index = None):
     """
     Fuzzy find the indexes of word in words, returns a list of indexes which match the
     best return from fuzzy.
     limit controls the number of choices to allow.
     include_stopwords controls whether the word can be matched against a stopword in words.
+    index - an optional (precomputed) WordIndex of words
     """
-    from nltk.corpus import stopwords
-    ignore_word = is_extended_stop_word if (not include_stopwords) \
-                      else lambda _: False
+    if index is None:
+        index = WordIndex(words)
 
     # Try finding exact matches
-    exact_matches = set([i for (i, w) in enumerate(words) if w == word])
-    if exact_matches:
-        return list(exact_matches)
+    if word in index.positions:
+        return list(set(index.positions[word]))
 
     # Allow some variance which extractOne misses
     # For example:
@@ -297,13 +709,14 @@ def fuzzy_match_word(word, words, limit,
     # "Armstrong World Industries Inc. agreed in principle to sell its carpet operations to Shaw Industries Inc ."
 
     # Start by removing stopwords if flag indicates so
-    filter_words = [w for w in words if
-                    (not ignore_word(w.lower()))]
-    best_matches  = [w for (w, s) in
-                     process.extract(word, filter_words, processor = semi_process, limit = limit)
-                     if (s > 70)]
-    return list(exact_matches.union([i for (i, w) in enumerate(words) if w in best_matches]))
+    filter_words = index.words if include_stopwords \
+                   else index.non_stopwords
+    best_matches = set([filter_words[i]
+                        for i in index.get_matcher(include_stopwords).extract(word, limit)])
 
+    return list(set([i
+                     for w in best_matches
+                     for i in index.positions[w]]))
 
 def semi_process(s, force_ascii=False):
     """
@@ -444,16 +857,42 @@ def find_heads(graph, nodes):
     return [node for node in nodes
             if not(find_parents(graph, node))]
 
+# Maximal number of tagged phrases to memoize, see pos_tag_phrases
+MAX_POS_TAG_CACHE_SIZE = 100000
+
+# Memoized results of pos_tag_phrases, keyed by tuple of tokens
+pos_tag_cache = {}
+
 def safe_pos_tag(sent):
     """
     Safeguards nltk's POS tag from crashing on:
     - Empty words
-    """
-    proc_sent = [(w if w \
-                  else " ")
-                  for w in map(asciidammit,
-                               sent)]
-    return nltk.pos_tag(proc_sent)
+    Results are memoized, see pos_tag_phrases.
+    """
+    return pos_tag_phrases([sent])[0]
+
+def pos_tag_phrases(phrases):
+    """
+    POS tag a list of tokenized phrases, tagging all of those which weren't
+    tagged before in a single call to nltk's tagger.
+    Returns the tagged phrases, in the same format as nltk.pos_tag.
+    """
+    keys = map(tuple, phrases)
+    new_keys = list(set([key for key in keys
+                         if key not in pos_tag_cache]))
+    if new_keys:
+        if len(pos_tag_cache) + len(new_keys) > MAX_POS_TAG_CACHE_SIZE:
+            # Start over, with only the current phrases
+            pos_tag_cache.clear()
+            new_keys = list(set(keys))
+        proc_phrases = [[(w if w \
+                          else " ")
+                         for w in map(asciidammit,
+                                      key)]
+                        for key in new_keys]
+        pos_tag_cache.update(zip(new_keys,
+                                 nltk.pos_tag_sents(proc_phrases)))
+    return [pos_tag_cache[key] for key in keys]
 
 def is_noun_tag(nltk_pos_tag):
     """
@@ -0,0 +1,170 @@
+""" Usage:
+    sentence_index --sents=SENT_FILE --id=SENTENCE_ID [<data_file>...]
+
+Print a sentence and all of its QAs in the given data files (e.g., data/filtered/dev.tsv).
+Lookups seek directly to the records, using sidecar byte offset indices (<file>.idx)
+which are built on first use and rebuilt whenever the data file changes.
+"""
+
+from docopt import docopt
+import os
+import tempfile
+import logging
+logging.basicConfig(level = logging.DEBUG)
+
+# Extension of the sidecar index files
+INDEX_EXT = ".idx"
+
+
+def get_index_fn(data_fn):
+    """
+    Returns the filename of the sidecar index of the given data file
+    """
+    return data_fn + INDEX_EXT
+
+def build_index(data_fn):
+    """
+    Scan a tab separated data file, keyed by its first field (sentence id),
+    and write a sidecar index from each id to the byte ranges of its records
+    (if the index can't be written, it's only returned).
+    Consecutive records of the same id are stored as a single range.
+    Returns the index as a dictionary from id to a list of (start, end) offsets.
+    """
+    ret = {}
+    cur_id = None
+    with open(data_fn, 'rb') as fin:
+        start = 0
+        while True:
+            line = fin.readline()
+            if not line:
+                break
+            end = start + len(line)
+            sent_id = line.split("\t", 1)[0].rstrip("\r\n")
+            if sent_id == cur_id:
+                # Extend the current range
+                ret[sent_id][-1] = (ret[sent_id][-1][0], end)
+            else:
+                ret.setdefault(sent_id, []).append((start, end))
+                cur_id = sent_id
+            start = end
+
+    logging.debug("Indexed {} ids in {}".format(len(ret), data_fn))
+    try:
+        write_index(ret, get_index_fn(data_fn))
+    except (IOError, OSError) as e:
+        # E.g., a read only data directory - use the index without storing it
+        logging.warning("Couldn't write index of {}: {}".format(data_fn, e))
+    return ret
+
+def write_index(index, index_fn):
+    """
+    Write an index (see build_index) to index_fn.
+    Written to a temporary file which then replaces index_fn,
+    so that readers never see a partially written index.
+    """
+    fd, tmp_fn = tempfile.mkstemp(dir = os.path.dirname(os.path.abspath(index_fn)),
+                                  prefix = os.path.basename(index_fn),
+                                  suffix = ".tmp")
+    try:
+        with os.fdopen(fd, 'w') as fout:
+            for sent_id, ranges in index.iteritems():
+                for (start, end) in ranges:
+                    fout.write("{}\t{}\t{}\n".format(sent_id, start, end))
+        os.rename(tmp_fn, index_fn)
+    except:
+        os.remove(tmp_fn)
+        raise
+
+def load_index(data_fn):
+    """
+    Load the sidecar index of the given data file,
+    (re)building it if it's missing or outdated.
+    """
+    index_fn = get_index_fn(data_fn)
+    if (not os.path.exists(index_fn)) or \
+       (os.path.getmtime(index_fn) < os.path.getmtime(data_fn)):
+        return build_index(data_fn)
+
+    ret = {}
+    for line in open(index_fn):
+        sent_id, start, end = line.rstrip("\n").split("\t")
+        ret.setdefault(sent_id, []).append((int(start), int(end)))
+    return ret
+
+
+class SentenceIndex:
+    """
+    Random access to sentences (and their QAs) by sentence id
+    """
+    def __init__(self, sents_fn, data_fns = []):
+        """
+        sents_fn - sentence file, mapping sentence id to sentence (e.g., data/wiki-sentences.tsv)
+        data_fns - QA data files (e.g., data/filtered/dev.tsv)
+        """
+        self.sents_fn = sents_fn
+        self.data_fns = list(data_fns)
+        self.indices = dict([(fn, load_index(fn))
+                             for fn in [sents_fn] + self.data_fns])
+        self.files = {}
+
+    def read_records(self, fn, sent_id):
+        """
+        Returns all of the records (lists of fields) for the given id in fn.
+        """
+        if fn not in self.files:
+            self.files[fn] = open(fn, 'rb')
+        fin = self.files[fn]
+        ret = []
+        for (start, end) in self.indices[fn].get(sent_id, []):
+            fin.seek(start)
+            ret.extend([line.rstrip("\r\n").split("\t")
+                        for line in fin.read(end - start).splitlines()])
+        return ret
+
+    def get_sentence(self, sent_id):
+        """
+        Returns the (space tokenized) sentence with the given id.
+        Raises KeyError if it doesn't exist.
+        """
+        records = self.read_records(self.sents_fn, sent_id)
+        if not records:
+            raise KeyError(sent_id)
+        return records[0][1]
+
+    def get_qas(self, sent_id):
+        """
+        Returns all of the QA rows (lists of fields) for the given sentence id,
+        across all data files.
+        """
+        return [row
+                for fn in self.data_fns
+                for row in self.read_records(fn, sent_id)]
+
+    def close(self):
+        """
+        Close all open file handles
+        """
+        for fin in self.files.values():
+            fin.close()
+        self.files = {}
+
+    def __getitem__(self, sent_id):
+        """
+        Allow using this index as a dictionary from sentence id to sentence
+        """
+        return self.get_sentence(sent_id)
+
+    def __contains__(self, sent_id):
+        """
+        Returns True iff the sentence id appears in the sentence file
+        """
+        return sent_id in self.indices[self.sents_fn]
+
+
+if __name__ == "__main__":
+    args = docopt(__doc__)
+    index = SentenceIndex(args["--sents"], args["<data_file>"])
+    sent_id = args["--id"]
+    print index.get_sentence(sent_id)
+    for row in index.get_qas(sent_id):
+        print "\t".join(row)
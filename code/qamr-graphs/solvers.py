@@ -1,6 +1,21 @@
 from itertools import product
 import logging
 import numpy
+import time
+
+# Tolerance for floating point comparison of scores
+EPSILON = 1e-9
+
+# Maximal number of assignments to evaluate at once with numpy
+MAX_VECTORIZED_ASSIGNMENTS = 50000
+
+
+class BudgetExceeded(Exception):
+    """
+    Raised when an exact minimization exceeds its budget (see discrete_minimizer)
+    """
+    pass
+
 
 def discrete_brute_minimizer(possible_vals, func):
     """
@@ -17,6 +32,168 @@ def discrete_brute_minimizer(possible_vals, func):
     ],
                key = lambda (_, score): score)
 
+def discrete_vectorized_minimizer(possible_vals):
+    """
+    Same as discrete_brute_minimizer(possible_vals, mean_distance_from_centroid),
+    but materializes all assignments as an int array and scores them with a few array operations.
+    Memory is linear in the number of assignments, see discrete_minimizer for choosing a solver.
+    """
+    if not possible_vals:
+        return discrete_brute_minimizer(possible_vals, mean_distance_from_centroid)
+
+    # Each row is an assignment, in the same order as itertools.product
+    assignments = numpy.array([grid.ravel()
+                               for grid in numpy.meshgrid(*possible_vals,
+                                                          indexing = 'ij')]).T
+
+    # Mask assignments in which a non-negative value repeats
+    sorted_assignments = numpy.sort(assignments, axis = 1)
+    repeats = (sorted_assignments[:, 1:] == sorted_assignments[:, :-1]) & \
+              (sorted_assignments[:, 1:] >= 0)
+    valid = ~repeats.any(axis = 1)
+    if not valid.any():
+        raise ValueError("No valid assignment for {}".format(possible_vals))
+
+    # Centroid of the non-negative values in each assignment (0 if there are none)
+    positive = (assignments >= 0)
+    counts = positive.sum(axis = 1)
+    centroids = (assignments * positive).sum(axis = 1) / numpy.maximum(counts, 1).astype(float)
+
+    scores = numpy.abs(assignments - centroids[:, numpy.newaxis]).mean(axis = 1)
+    scores[~valid] = numpy.inf
+    best = numpy.argmin(scores)
+    return tuple(assignments[best].tolist()), scores[best]
+
+def discrete_minimizer(possible_vals, max_assignments = None, deadline = None):
+    """
+    Minimize mean_distance_from_centroid over assignments from possible vals,
+    using the vectorized brute force for small candidate sets, and branch and bound otherwise.
+    Optionally bounded, raises BudgetExceeded if:
+    max_assignments - the number of possible assignments is larger than this
+    deadline - time.time() passes this point during the branch and bound search
+    """
+    num_of_assignments = reduce(lambda x, y: x * y,
+                                map(len, possible_vals),
+                                1)
+    if (max_assignments is not None) and (num_of_assignments > max_assignments):
+        raise BudgetExceeded("{} possible assignments".format(num_of_assignments))
+    if num_of_assignments <= MAX_VECTORIZED_ASSIGNMENTS:
+        return discrete_vectorized_minimizer(possible_vals)
+    return discrete_centroid_minimizer(possible_vals, deadline = deadline)
+
+def discrete_greedy_minimizer(possible_vals):
+    """
+    Fast approximation of discrete_minimizer, for when it exceeds its budget.
+    Starting from each of the non-negative options as an initial centroid, assigns the words
+    in order of increasing number of options, each to its (unused) option nearest to the
+    centroid of the values assigned so far.
+    Returns the best (assignment, score) over all starting points.
+    """
+    if not possible_vals:
+        return discrete_brute_minimizer(possible_vals, mean_distance_from_centroid)
+
+    order = sorted(range(len(possible_vals)),
+                   key = lambda word_ind: len(possible_vals[word_ind]))
+    starts = sorted(set([val
+                         for opts in possible_vals
+                         for val in opts
+                         if val >= 0])) or [0]
+
+    best = (None, numpy.inf)
+    for centroid in starts:
+        assignment = [None] * len(possible_vals)
+        used = set()
+        for word_ind in order:
+            opts = [val for val in possible_vals[word_ind]
+                    if val not in used]
+            if not opts:
+                break
+            val = min(opts, key = lambda val: abs(val - centroid))
+            assignment[word_ind] = val
+            if val >= 0:
+                used.add(val)
+                centroid = float(sum(used)) / len(used)
+        else:
+            score = mean_distance_from_centroid(assignment)
+            if score < best[1]:
+                best = (tuple(assignment), score)
+
+    if best[0] is None:
+        raise ValueError("No valid assignment for {}".format(possible_vals))
+    return best
+
+def discrete_centroid_minimizer(possible_vals, deadline = None):
+    """
+    Exact minimizer of mean_distance_from_centroid over the assignments from possible vals
+    (list of lists of possible values) in which the non-negative values are unique.
+    Returns the same (assignment, score) as
+    discrete_brute_minimizer(possible_vals, mean_distance_from_centroid),
+    ties are broken in favour of the first assignment in enumeration order.
+    Uses depth first branch and bound, with the following lower bound for a partial assignment:
+    the final centroid is some point p, and each unassigned word will be at least as far from p as
+    its closest option. Minimizing over all candidate points p (zero and all non-negative options)
+    bounds the cost of any completion.
+    deadline - if given, raise BudgetExceeded once time.time() passes it
+    """
+    num_of_words = len(possible_vals)
+    if not num_of_words:
+        return discrete_brute_minimizer(possible_vals, mean_distance_from_centroid)
+
+    # Candidate centroids - the bound is piecewise linear in p, and can only be minimized
+    # at one of these points
+    points = numpy.array(sorted(set([0] + [val
+                                           for opts in possible_vals
+                                           for val in opts
+                                           if val >= 0])),
+                         dtype = float)
+
+    # remaining[i][p] - the minimal total distance of words i, i+1, ... from point p
+    closest = numpy.array([numpy.abs(numpy.subtract.outer(opts, points)).min(axis = 0)
+                           for opts in possible_vals])
+    remaining = numpy.vstack([numpy.cumsum(closest[::-1], axis = 0)[::-1],
+                              numpy.zeros(len(points))])
+
+    best = [None, numpy.inf]
+    assignment = []
+    used = set()
+
+    def search(word_ind, cost):
+        """
+        Extend the current partial assignment of the first word_ind words,
+        cost[p] is the total distance of the assigned words from point p
+        """
+        if (deadline is not None) and (time.time() > deadline):
+            raise BudgetExceeded("Deadline passed")
+
+        lower_bound = numpy.min(cost + remaining[word_ind]) / num_of_words
+        if lower_bound > best[1] + EPSILON:
+            # Can't improve on (or tie with) the current best assignment
+            return
+
+        if word_ind == num_of_words:
+            score = mean_distance_from_centroid(assignment)
+            if score < best[1]:
+                best[0] = tuple(assignment)
+                best[1] = score
+            return
+
+        for val in possible_vals[word_ind]:
+            if val in used:
+                continue
+            if val >= 0:
+                used.add(val)
+            assignment.append(val)
+            search(word_ind + 1,
+                   cost + numpy.abs(points - val))
+            assignment.pop()
+            used.discard(val)
+
+    search(0, numpy.zeros(len(points)))
+
+    if best[0] is None:
+        raise ValueError("No valid assignment for {}".format(possible_vals))
+    return best[0], best[1]
+
 def mean_distance_from_centroid(cluster):
     """
     Given a cluster of *POSITIVE* coordinates, calculate the mean absolute distance
@@ -36,3 +213,33 @@ def mean_distance_from_centroid(cluster):
 if __name__ == "__main__":
     ls = [[1, -100], [5], [6], [-4]]
     ass = discrete_brute_minimizer(ls, mean_distance_from_centroid)
+
+    # Verify the exact solver against brute force on small random inputs
+    import random
+    for _ in range(1000):
+        sent_len = random.randint(1, 15)
+        possible_vals = [random.sample(range(sent_len), random.randint(1, min(4, sent_len))) + \
+                         ([-sent_len] if random.random() < 0.3 else [])
+                         for _ in range(random.randint(1, 5))]
+        try:
+            expected = discrete_brute_minimizer(possible_vals, mean_distance_from_centroid)
+        except ValueError:
+            continue
+        for solver in [discrete_centroid_minimizer, discrete_vectorized_minimizer]:
+            actual = solver(possible_vals)
+            assert (tuple(expected[0]) == actual[0]) and (expected[1] == actual[1]), \
+                (solver.__name__, possible_vals, expected, actual)
+    logging.info("Exact and vectorized solvers match brute force")
+
+    # The greedy solver finds valid (though not necessarily optimal) assignments
+    for _ in range(1000):
+        sent_len = random.randint(1, 15)
+        possible_vals = [random.sample(range(sent_len), random.randint(1, min(4, sent_len))) + [-sent_len]
+                         for _ in range(random.randint(1, 5))]
+        expected = discrete_brute_minimizer(possible_vals, mean_distance_from_centroid)
+        actual = discrete_greedy_minimizer(possible_vals)
+        positive = [val for val in actual[0] if val >= 0]
+        assert (len(set(positive)) == len(positive)) and \
+            all([val in opts for val, opts in zip(actual[0], possible_vals)]) and \
+            (actual[1] >= expected[1] - EPSILON), (possible_vals, expected, actual)
+    logging.info("Greedy solver finds valid assignments")
@@ -2,14 +2,38 @@
 Functions to mediate the spaCy interface.
 """
 
-import spacy
-from spacy.tokens import Doc
 from preproc import enum
+from preproc import iter_batches
+from parse_cache import get_parse_key
+from compact_parse import CompactParse, get_fields
+from multiprocessing import Pool
 from operator import itemgetter
+import json
 import logging
 import pdb
 logging.basicConfig(level = logging.DEBUG)
 
+## Name of the loaded spaCy model
+MODEL_NAME = 'en'
+
+## Pipeline components which can be requested from get_parser
+## (besides tokenization, which is always done on white spaces)
+TAGGER = ("tagger",)
+TAGGER_AND_PARSER = ("tagger", "parser")
+ALL_COMPONENTS = ("tagger", "parser", "entity")
+
+## Default number of texts which spaCy processes together in parse_texts
+PARSE_BATCH_SIZE = 1000
+
+## Process wide on-disk cache of parses (a ParseCache), see set_parse_cache
+parse_cache = None
+
+## Process wide pool of parsing processes (a ParsePool), see get_parse_pool
+parse_pool = None
+
+## Version of the installed model, see get_model_version
+model_version = None
+
 ## Enum class for representing a chunk's side, relative
 ## to the head.
 Sides = enum(LEFT = -1,
@@ -194,6 +218,8 @@ class WhitespaceTokenizer(object):
         """
         Get an initialized spacy object
         """
+        from spacy.tokens import Doc
+        self.doc_class = Doc
         self.vocab = nlp.vocab
 
     def __call__(self, text):
@@ -203,7 +229,7 @@ class WhitespaceTokenizer(object):
         words = text.split(' ')
         # All tokens 'own' a subsequent space character in this tokenizer
         spaces = [True] * len(words)
-        return Doc(self.vocab, words=words, spaces=spaces)
+        return self.doc_class(self.vocab, words=words, spaces=spaces)
 
 
 
@@ -221,9 +247,39 @@ def set_sent_starts(doc):
 class spacy_with_whitespace_tokenizer:
     """
     Get a spacy parser instance with white space tokenization.
+    The model is loaded on first use, once per process and requested components.
     """
-    parser = spacy.load('en',
-                        create_make_doc = WhitespaceTokenizer)
+    # Map from a tuple of loaded components to the parser instance
+    parsers = {}
+
+    @staticmethod
+    def get_parser(components = TAGGER_AND_PARSER):
+        """
+        Returns a parser running (at least) the given pipeline components,
+        loading the model if no loaded instance has all of them.
+        """
+        components = set(components)
+        if "parser" in components:
+            # The dependency parser depends on the POS tags
+            components.add("tagger")
+        for loaded_components, parser in spacy_with_whitespace_tokenizer.parsers.iteritems():
+            if components.issubset(loaded_components):
+                return parser
+
+        import spacy
+        loaded_components = tuple([component
+                                   for component in ALL_COMPONENTS
+                                   if component in components])
+        logging.debug("Loading spaCy model with components: {}".format(loaded_components))
+        # spaCy uses override values as the components themselves,
+        # so only the disabled components are overridden (with False)
+        parser = spacy.load(MODEL_NAME,
+                            create_make_doc = WhitespaceTokenizer,
+                            **dict([(component, False)
+                                    for component in ALL_COMPONENTS
+                                    if component not in components]))
+        spacy_with_whitespace_tokenizer.parsers[loaded_components] = parser
+        return parser
 
     # TODO: migrate to spacy V2.0, make sure that whitespacetokenizer still
     #       works
@@ -381,6 +437,25 @@ def find_root(phrase):
                       format(phrase, roots))
     return roots[0]
 
+def find_span_root(doc, start, end):
+    """
+    Returns the root of the span [start, end) in a sentence level parse -
+    its token which is closest to the root of the sentence
+    (ties are broken by position).
+    """
+    return min([doc[i] for i in range(start, end)],
+               key = lambda tok: (get_depth(tok), tok.i))
+
+def get_depth(tok):
+    """
+    Returns the number of edges between tok and the root of its parse
+    """
+    depth = 0
+    while tok.head.i != tok.i:
+        tok = tok.head
+        depth += 1
+    return depth
+
 
 def is_aux(tok):
     """
@@ -513,16 +588,202 @@ def get_conll(doc):
     return "\n".join(ret)
 
 
-def spacy_whitespace_parser(text, encoding = "utf8"):
+def get_parser(components = TAGGER_AND_PARSER):
+    """
+    Returns the process wide white space tokenized parser, see
+    spacy_with_whitespace_tokenizer.get_parser.
+    """
+    return spacy_with_whitespace_tokenizer.get_parser(components)
+
+def set_parse_cache(cache):
+    """
+    Look up and store all parses in the given ParseCache (or stop caching, if cache is None)
+    """
+    global parse_cache
+    parse_cache = cache
+
+def get_model_version():
+    """
+    Returns a string identifying the spaCy version and the installed model (see get_parser).
+    Read from the model's meta data (the same way spacy.load finds it), without loading the model.
+    """
+    global model_version
+    if model_version is None:
+        import spacy
+        data_path = spacy.util.get_data_path()
+        meta = (spacy.util.parse_package_meta(data_path,
+                                              spacy.resolve_model_name(MODEL_NAME),
+                                              require = False) \
+                if data_path is not None else None) or {}
+        model_version = "/".join([spacy.about.__version__,
+                                  str(meta.get("lang", MODEL_NAME)),
+                                  str(meta.get("name", "")),
+                                  str(meta.get("version", ""))])
+    return model_version
+
+def parse_texts(texts, components = TAGGER_AND_PARSER,
+                batch_size = PARSE_BATCH_SIZE, n_process = 1):
+    """
+    Parse a list of (unicode, space tokenized) texts in bulk, with spaCy's
+    batched pipeline (nlp.pipe). Returns the list of corresponding parses (as CompactParse).
+    n_process - if larger than 1, texts are parsed by a pool of n_process worker processes,
+                see ParsePool.
+    If a parse cache is set, cached parses are loaded instead of parsed,
+    and new parses are added to the cache. The model is loaded (or the parse pool started)
+    only if some of the texts are missing from the cache.
+    Texts which can't be white space tokenized (see is_parsable) get None as parse.
+    """
+    parsable = [i
+                for i, text in enumerate(texts)
+                if is_parsable(text)]
+    if len(parsable) != len(texts):
+        logging.warning("Not parsing {} texts with empty tokens".format(len(texts) - len(parsable)))
+
+    if parse_cache is None:
+        parses = dict(zip(parsable,
+                          pipe_texts([texts[i] for i in parsable],
+                                     components, batch_size, n_process)))
+        return [parses.get(i)
+                for i in range(len(texts))]
+
+    keys = dict([(i, get_parse_key(texts[i], get_model_version(), components))
+                 for i in parsable])
+    cached = dict([(i, parse_cache.get(key))
+                   for i, key in keys.iteritems()])
+    missing = sorted([i
+                      for i, data in cached.iteritems()
+                      if data is None])
+    parses = dict(zip(missing,
+                      pipe_texts([texts[i] for i in missing],
+                                 components, batch_size, n_process)))
+    for i, parse in parses.iteritems():
+        parse_cache.add(keys[i], json.dumps(parse.get_fields()))
+    for i, data in cached.iteritems():
+        if data is not None:
+            parses[i] = CompactParse(json.loads(data))
+    return [parses.get(i)
+            for i in range(len(texts))]
+
+def is_parsable(text):
+    """
+    Returns True iff text can be tokenized by WhitespaceTokenizer - spaCy can't
+    build a Doc with empty words, such as those made by leading, trailing or double spaces.
+    """
+    return all(text.split(' '))
+
+def parse_text(text, components = TAGGER_AND_PARSER):
+    """
+    Parse a single (unicode, space tokenized) text, see parse_texts.
+    """
+    return parse_texts([text], components)[0]
+
+def pipe_texts(texts, components, batch_size, n_process):
+    """
+    Run texts through spaCy's pipeline, in this process or in the parse pool,
+    see parse_texts.
+    """
+    if not texts:
+        return []
+    if n_process > 1:
+        return get_parse_pool(n_process, components).parse(texts, components, batch_size)
+    return [CompactParse.from_doc(doc)
+            for doc in get_parser(components).pipe(texts,
+                                                   batch_size = batch_size)]
+
+
+class ParsePool:
+    """
+    Parse texts in a pool of worker processes, each loading the (white space tokenized)
+    model once, in the pool initializer. Workers return the compact fields of their parses
+    (see compact_parse.get_fields) rather than pickled Docs.
+    """
+    def __init__(self, n_process, components = TAGGER_AND_PARSER):
+        """
+        n_process - number of worker processes
+        components - pipeline components to load in each worker, see get_parser
+        """
+        self.n_process = n_process
+        self.components = components
+        self.pool = Pool(n_process,
+                         initializer = init_parse_worker,
+                         initargs = (components,))
+        logging.debug("Started {} parsing processes".format(n_process))
+
+    def parse(self, texts, components = TAGGER_AND_PARSER, batch_size = PARSE_BATCH_SIZE):
+        """
+        Parse a list of (unicode, space tokenized) texts, returns a list of CompactParse.
+        Texts are split evenly between the workers, in tasks of at most batch_size texts.
+        """
+        task_size = min(batch_size,
+                        (len(texts) + self.n_process - 1) / self.n_process)
+        tasks = [(batch, components, batch_size)
+                 for batch in iter_batches(texts, max(task_size, 1))]
+        return [CompactParse(fields)
+                for batch_fields in self.pool.map(parse_worker, tasks)
+                for fields in batch_fields]
+
+    def close(self, terminate = False):
+        """
+        Stop the worker processes
+        terminate - stop them immediately, without waiting for pending tasks (e.g., on errors)
+        """
+        if terminate:
+            self.pool.terminate()
+        else:
+            self.pool.close()
+        self.pool.join()
+
+
+def init_parse_worker(components):
+    """
+    Load the model in a parse pool worker process
+    """
+    get_parser(components)
+
+def parse_worker(task):
+    """
+    Parse a batch of texts in a parse pool worker.
+    task - (texts, components, batch_size)
+    Returns the compact fields of each parse.
+    """
+    texts, components, batch_size = task
+    return [get_fields(doc)
+            for doc in get_parser(components).pipe(texts,
+                                                   batch_size = batch_size)]
+
+def get_parse_pool(n_process, components = TAGGER_AND_PARSER):
+    """
+    Returns the process wide pool of n_process parsing processes, running the given
+    pipeline components, which is started on first use.
+    """
+    global parse_pool
+    if (parse_pool is None) or \
+       ((parse_pool.n_process, parse_pool.components) != (n_process, tuple(components))):
+        close_parse_pool()
+        parse_pool = ParsePool(n_process, tuple(components))
+    return parse_pool
+
+def close_parse_pool(terminate = False):
+    """
+    Stop the parse pool, if it was started, see ParsePool.close
+    """
+    global parse_pool
+    if parse_pool is not None:
+        parse_pool.close(terminate)
+        parse_pool = None
+
+
+def spacy_whitespace_parser(text, encoding = "utf8", components = TAGGER_AND_PARSER):
     """
-    Parse sentence with static instance.
+    Parse sentence with static instance, returns a spaCy Doc
+    (see parse_text for a cached, compact parse).
     """
-    return spacy_with_whitespace_tokenizer.parser(unicode(text,
-                                                          encoding))
+    return get_parser(components)(unicode(text,
+                                          encoding))
 
 if __name__ == "__main__":
     """
     Sanity checks
     """
-    doc1 = spacy_with_whitespace_tokenizer.parser(unicode("Who's the U.S. first president?"))
-    doc2 = spacy_with_whitespace_tokenizer.parser(unicode("Who may call the new president ?"))
+    doc1 = get_parser()(unicode("Who's the U.S. first president?"))
+    doc2 = get_parser()(unicode("Who may call the new president ?"))
@@ -0,0 +1,23 @@
+""" Usage:
+    tokenize_exp --in=INPUT_FILE --out=OUTPUT_FILE [--jobs=N]
+
+    Tokenize the sentences and QAs in a given experiment file
+    outputs the tokenized version into out_fn
+
+Options:
+    --jobs=N  Number of worker processes to tokenize with [default: 1]
+"""
+
+from docopt import docopt
+from preproc import tokenize_experiment
+import logging
+logging.basicConfig(level = logging.DEBUG)
+
+if __name__ == "__main__":
+    args = docopt(__doc__)
+    inp = args["--in"]
+    out = args["--out"]
+    jobs = int(args["--jobs"])
+    logging.info("Tokenizing experiment file {} into {} ...".format(inp, out))
+    tokenize_experiment(inp, out, jobs = jobs)
+    logging.info("DONE!")